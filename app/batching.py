@@ -0,0 +1,80 @@
+"""This module merges the single predictions arriving at the same time into one
+model call, the per call overhead of sklearn is then paid once for the batch.
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import numpy as np
+
+from app.metrics import Histogram
+
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+WAIT_BUCKETS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1]
+
+
+class MicroBatcher:
+    """Collects feature rows for up to max_wait seconds or max_batch rows and scores
+    them together, every caller then gets the score of its own row.
+
+    The run callable executes the predict function, usually away from the event loop.
+    """
+
+    # pylint: disable=too-many-instance-attributes, too-few-public-methods
+
+    def __init__(
+        self,
+        predict: Callable[[np.ndarray], np.ndarray],
+        run: Callable[..., Awaitable[np.ndarray]],
+        max_wait: float = 0.002,
+        max_batch: int = 64,
+    ):
+        self.predict = predict
+        self.run = run
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.wait_time = Histogram(WAIT_BUCKETS)
+        self._pending: List[Tuple[np.ndarray, asyncio.Future, float]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def submit(self, row: np.ndarray) -> float:
+        """Queues a feature row and waits for its score."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((row, future, loop.time()))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._score(batch))
+
+    async def _score(self, batch: List[Tuple[np.ndarray, asyncio.Future, float]]):
+        now = asyncio.get_running_loop().time()
+        self.batch_size.observe(len(batch))
+        for _, _, queued_at in batch:
+            self.wait_time.observe(now - queued_at)
+
+        try:
+            scores = await self.run(
+                self.predict, np.vstack([row for row, _, _ in batch])
+            )
+        except Exception as error:  # pylint: disable=broad-except
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for (_, future, _), score in zip(batch, scores):
+            if not future.done():
+                future.set_result(float(score))
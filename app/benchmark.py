@@ -0,0 +1,470 @@
+"""This module measures the latency and throughput of the prediction API.
+
+A recorded mix of requests is replayed against the app, in process through its ASGI
+interface or against a running server, at several concurrency levels. Results can be
+saved as a baseline and later runs compared to it, the command fails when an endpoint
+got slower than the allowed tolerance.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import resource
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("ml-tools")
+
+MIX_PATH = "benchmarks/request_mix.jsonl"
+BASELINE_PATH = "benchmarks/baseline.json"
+WARMUP_REQUESTS = 20
+
+
+@dataclass
+class RecordedRequest:
+    """One request of the mix, sent weight times per round."""
+
+    name: str
+    method: str
+    path: str
+    json: Optional[object] = None
+    weight: int = 1
+
+
+@dataclass
+class Result:
+    """Measures of one endpoint at one concurrency level."""
+
+    # pylint: disable=too-many-instance-attributes
+    requests: int
+    errors: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    requests_per_second: float
+    # Peak resident memory of the benchmark process, None against a remote server.
+    peak_rss_mb: Optional[float]
+    # CPU time of the process per request, client included, None against a server.
+    cpu_ms: Optional[float] = None
+
+
+def load_mix(path: str = MIX_PATH) -> List[RecordedRequest]:
+    """Reads the recorded requests, one JSON object per line."""
+    with open(path, encoding="utf-8") as file:
+        return [RecordedRequest(**json.loads(line)) for line in file if line.strip()]
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process since it started."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def replay(
+    client: httpx.AsyncClient,
+    requests: List[RecordedRequest],
+    concurrency: int,
+    total: int,
+) -> Dict[str, List[float]]:
+    """Sends total requests from the weighted mix, concurrency at a time.
+
+    Returns the latencies in seconds per request name, failed calls as NaN.
+    """
+    schedule = [request for request in requests for _ in range(request.weight)]
+    latencies: Dict[str, List[float]] = {request.name: [] for request in requests}
+    position = iter(range(total))
+
+    async def worker():
+        for sent in position:
+            request = schedule[sent % len(schedule)]
+            start = time.perf_counter()
+            response = await client.request(
+                request.method, request.path, json=request.json
+            )
+            elapsed = time.perf_counter() - start
+            failed = response.status_code >= 400
+            latencies[request.name].append(float("nan") if failed else elapsed)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+def summarize(
+    latencies: List[float],
+    duration: float,
+    rss: Optional[float],
+    cpu: Optional[float] = None,
+) -> Result:
+    """Computes the percentiles and throughput of one endpoint, cpu is the CPU time
+    in seconds used to send them.
+    """
+    values = np.array(latencies)
+    succeeded = values[~np.isnan(values)] * 1000
+    p50, p95, p99 = (
+        np.percentile(succeeded, [50, 95, 99]) if len(succeeded) else [np.nan] * 3
+    )
+    return Result(
+        requests=len(values),
+        errors=int(np.isnan(values).sum()),
+        p50_ms=round(float(p50), 3),
+        p95_ms=round(float(p95), 3),
+        p99_ms=round(float(p99), 3),
+        requests_per_second=round(len(values) / duration, 1),
+        peak_rss_mb=None if rss is None else round(rss, 1),
+        cpu_ms=None if cpu is None else round(cpu / len(values) * 1000, 3),
+    )
+
+
+def best_of(results: List[Result]) -> Result:
+    """Keeps the best value of every measure over repeated runs, which is the most
+    stable one on a busy machine. Errors are summed.
+    """
+    return Result(
+        requests=sum(result.requests for result in results),
+        errors=sum(result.errors for result in results),
+        p50_ms=min(result.p50_ms for result in results),
+        p95_ms=min(result.p95_ms for result in results),
+        p99_ms=min(result.p99_ms for result in results),
+        requests_per_second=max(result.requests_per_second for result in results),
+        peak_rss_mb=results[-1].peak_rss_mb,
+        cpu_ms=None if results[0].cpu_ms is None else min(r.cpu_ms for r in results),
+    )
+
+
+async def measure_once(
+    client: httpx.AsyncClient,
+    requests: List[RecordedRequest],
+    concurrency: int,
+    total: int,
+    local: bool,
+) -> Result:
+    """Runs the requests of one endpoint once at a concurrency level."""
+    start, cpu_start = time.perf_counter(), time.process_time()
+    latencies = await replay(client, requests, concurrency, total)
+    duration = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start if local else None
+    rss = peak_rss_mb() if local else None
+    return summarize(latencies[requests[0].name], duration, rss, cpu)
+
+
+async def run_benchmark(  # pylint: disable=too-many-arguments
+    client: httpx.AsyncClient,
+    mix: List[RecordedRequest],
+    concurrency_levels: List[int],
+    total: int,
+    *,
+    local: bool,
+    repeat: int = 3,
+) -> Dict[str, Dict[str, Dict]]:
+    """Replays every endpoint of the mix alone at every concurrency level, after a
+    few unmeasured requests to warm up the caches. Every level is run repeat times.
+
+    Returns the results by endpoint name then concurrency level.
+    """
+    results: Dict[str, Dict[str, Dict]] = {}
+    for name in dict.fromkeys(request.name for request in mix):
+        requests = [request for request in mix if request.name == name]
+        await replay(client, requests, 1, WARMUP_REQUESTS)
+        for concurrency in concurrency_levels:
+            result = best_of(
+                [
+                    await measure_once(client, requests, concurrency, total, local)
+                    for _ in range(repeat)
+                ]
+            )
+            results.setdefault(name, {})[str(concurrency)] = asdict(result)
+            logger.info("%s x%s: %s", name, concurrency, result)
+    return results
+
+
+async def benchmark_app(
+    mix: List[RecordedRequest], concurrency_levels: List[int], total: int, repeat: int
+) -> Dict[str, Dict[str, Dict]]:
+    """Runs the benchmark against the app in this process."""
+    # Imported here so benchmarking a remote server does not load the model.
+    from app.prediction_server import app  # pylint: disable=import-outside-toplevel
+
+    await app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark"
+        ) as client:
+            return await run_benchmark(
+                client, mix, concurrency_levels, total, local=True, repeat=repeat
+            )
+    finally:
+        await app.router.shutdown()
+
+
+async def benchmark_url(  # pylint: disable=too-many-arguments
+    url: str,
+    mix: List[RecordedRequest],
+    concurrency_levels: List[int],
+    total: int,
+    repeat: int,
+) -> Dict[str, Dict[str, Dict]]:
+    """Runs the benchmark against a running server."""
+    limits = httpx.Limits(max_connections=max(concurrency_levels))
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        return await run_benchmark(
+            client, mix, concurrency_levels, total, local=False, repeat=repeat
+        )
+
+
+def benchmark_training() -> Dict[str, Dict[str, Dict]]:
+    """Measures one full training run."""
+    # pylint: disable=import-outside-toplevel
+    from app import model_store
+
+    start = time.perf_counter()
+    model_store.train_artifact()
+    result = summarize([time.perf_counter() - start], 1.0, peak_rss_mb())
+    return {"train": {"1": asdict(result)}}
+
+
+def memory_report() -> Dict[str, Dict[str, float]]:
+    """Measures the peak resident memory after every training stage, with the size
+    of the data the stage produced.
+    """
+    # pylint: disable=import-outside-toplevel
+    from app import ml_tools
+
+    report = {"start": {"peak_rss_mb": round(peak_rss_mb(), 1), "data_mb": 0.0}}
+    train, target = ml_tools.load_data()
+    data_mb = (train.memory_usage().sum() + target.memory_usage().sum()) / 2**20
+    report["load"] = {"peak_rss_mb": round(peak_rss_mb(), 1), "data_mb": data_mb}
+    matrix, _ = ml_tools.prepare_train_data(train)
+    data_mb = matrix.memory_usage().sum() / 2**20
+    report["prepare"] = {"peak_rss_mb": round(peak_rss_mb(), 1), "data_mb": data_mb}
+    model = ml_tools.train_model(matrix, target)
+    states = [estimator.tree_.__getstate__() for estimator in model.estimators_]
+    data_mb = sum(state["nodes"].nbytes + state["values"].nbytes for state in states)
+    data_mb /= 2**20
+    report["train"] = {"peak_rss_mb": round(peak_rss_mb(), 1), "data_mb": data_mb}
+    for stage in report.values():
+        stage["data_mb"] = round(float(stage["data_mb"]), 1)
+    return report
+
+
+def encoding_cost(encode, decode, repeat: int) -> Dict[str, float]:
+    """Size of a payload and CPU microseconds to encode then decode it once."""
+    payload = encode()
+    start = time.process_time()
+    for _ in range(repeat):
+        decode(encode())
+    cpu_us = (time.process_time() - start) / repeat * 1e6
+    return {"bytes": len(payload), "cpu_us": round(cpu_us, 1)}
+
+
+def serialization_report(
+    rows: int = 10_000, repeat: int = 50
+) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Compares the size and the encoding plus client decoding CPU of the responses
+    with the encodings used before orjson, which went through jsonable_encoder and
+    the standard json module and sent data frames as JSON strings inside JSON.
+    """
+    # pylint: disable=import-outside-toplevel, too-many-locals
+    from fastapi.encoders import jsonable_encoder
+
+    from app import encoding, ml_tools, model_store
+
+    def standard_json(content) -> bytes:
+        # What the default JSONResponse does.
+        return json.dumps(
+            jsonable_encoder(content), allow_nan=False, separators=(",", ":")
+        ).encode()
+
+    artifact = model_store.load_artifact()
+    importance = pd.DataFrame(json.loads(artifact.importance_payload))
+    stats = ml_tools.AcceptedStats(ml_tools.load_and_concatenate_data())
+    description, counts = stats.to_list()
+    frames = [pd.DataFrame(**item) for item in [description, *counts]]
+    scores = np.random.default_rng(0).random(rows)
+    prediction = {"prediction_id": "0" * 32, "score": 0.5}
+
+    report = {
+        "feature_importance": {
+            "before": encoding_cost(
+                lambda: json.dumps(importance.to_json(orient="split")).encode(),
+                lambda data: pd.read_json(json.loads(data), orient="split"),
+                repeat,
+            ),
+            "after": encoding_cost(
+                lambda: encoding.dumps(importance.to_dict(orient="list")),
+                lambda data: pd.DataFrame(json.loads(data)),
+                repeat,
+            ),
+        },
+        "accepted_description": {
+            "before": encoding_cost(
+                lambda: json.dumps(
+                    [
+                        frames[0].to_json(orient="split"),
+                        [
+                            frame.iloc[:, 0].to_json(orient="split")
+                            for frame in frames[1:]
+                        ],
+                    ]
+                ).encode(),
+                lambda data: [
+                    pd.read_json(item, orient="split", typ=typ)
+                    for item, typ in zip(
+                        [json.loads(data)[0], *json.loads(data)[1]],
+                        ["frame", "series", "series", "series"],
+                    )
+                ],
+                repeat,
+            ),
+            "after": encoding_cost(
+                lambda: encoding.dumps(stats.to_list()),
+                lambda data: [
+                    pd.DataFrame(**item)
+                    for item in [json.loads(data)[0], *json.loads(data)[1]]
+                ],
+                repeat,
+            ),
+        },
+        "make_prediction": {
+            "before": encoding_cost(
+                lambda: standard_json(prediction), json.loads, repeat * 100
+            ),
+            "after": encoding_cost(
+                lambda: encoding.dumps(prediction), json.loads, repeat * 100
+            ),
+        },
+        f"make_predictions_{rows}": {
+            "before": encoding_cost(
+                lambda: json.dumps(scores.tolist()).encode(), json.loads, repeat
+            ),
+            "after": encoding_cost(lambda: encoding.dumps(scores), json.loads, repeat),
+        },
+    }
+    if encoding.arrow_available():
+        import pyarrow as pa
+
+        report[f"make_predictions_{rows}"]["arrow"] = encoding_cost(
+            lambda: encoding.to_arrow(pd.DataFrame({"score": scores})),
+            lambda data: pa.ipc.open_stream(data).read_pandas(),
+            repeat,
+        )
+    return report
+
+
+def compare(
+    results: Dict[str, Dict[str, Dict]],
+    baseline: Dict[str, Dict[str, Dict]],
+    tolerance: float = 0.25,
+    min_delta_ms: float = 1.0,
+) -> List[str]:
+    """Lists the measures worse than the baseline by more than the tolerance.
+
+    Latencies may not grow and throughput may not drop by more than the tolerance,
+    latencies within min_delta_ms of the baseline are taken as noise. Any error is a
+    regression, measures missing from either side are skipped.
+    """
+    regressions = []
+    for name, levels in results.items():
+        for concurrency, result in levels.items():
+            reference = baseline.get(name, {}).get(concurrency)
+            if reference is None:
+                continue
+            label = f"{name} x{concurrency}"
+            if result["errors"]:
+                regressions.append(f"{label}: {result['errors']} errors")
+            for measure in ["p50_ms", "p95_ms", "p99_ms"]:
+                limit = max(
+                    reference[measure] * (1 + tolerance),
+                    reference[measure] + min_delta_ms,
+                )
+                if result[measure] > limit:
+                    regressions.append(
+                        f"{label}: {measure} {result[measure]} > {reference[measure]}"
+                    )
+            rps = result["requests_per_second"]
+            if rps < reference["requests_per_second"] * (1 - tolerance):
+                regressions.append(
+                    f"{label}: requests_per_second {rps} < "
+                    f"{reference['requests_per_second']}"
+                )
+    return regressions
+
+
+def main(args: Optional[List[str]] = None):
+    """Command line entry point to benchmark the API."""
+    parser = argparse.ArgumentParser(description="Benchmark the prediction API.")
+    parser.add_argument("--mix", default=MIX_PATH)
+    parser.add_argument("--url", help="running server, the app in process if not given")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="per level")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per level")
+    parser.add_argument("--train", action="store_true", help="also time training")
+    parser.add_argument(
+        "--memory", action="store_true", help="only report the training memory"
+    )
+    parser.add_argument(
+        "--serialization",
+        action="store_true",
+        help="only compare the response encodings",
+    )
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--min-delta-ms", type=float, default=1.0)
+    parser.add_argument("--output", help="file to write the results to")
+    options = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    if options.memory:
+        print(json.dumps(memory_report(), indent=2))
+        return
+    if options.serialization:
+        print(json.dumps(serialization_report(), indent=2))
+        return
+    mix = load_mix(options.mix)
+    if options.url:
+        coroutine = benchmark_url(
+            options.url, mix, options.concurrency, options.requests, options.repeat
+        )
+    else:
+        coroutine = benchmark_app(
+            mix, options.concurrency, options.requests, options.repeat
+        )
+    results = asyncio.run(coroutine)
+    if options.train:
+        results.update(benchmark_training())
+
+    report = json.dumps(results, indent=2)
+    print(report)
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as file:
+            file.write(report)
+
+    if options.save_baseline:
+        with open(options.baseline, "w", encoding="utf-8") as file:
+            file.write(report + "\n")
+        logger.info("Baseline saved to %s", options.baseline)
+        return
+
+    try:
+        with open(options.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        logger.warning("No baseline at %s, nothing to compare", options.baseline)
+        return
+    regressions = compare(results, baseline, options.tolerance, options.min_delta_ms)
+    for regression in regressions:
+        logger.error("REGRESSION %s", regression)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
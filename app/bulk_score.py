@@ -0,0 +1,165 @@
+"""This module scores large customer files offline, without going through the API.
+
+The input file is read by chunks that are scored in a pool of processes, each one
+loading the persisted model once. Scores are written in the input order.
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from app import ml_tools, model_store
+
+logger = logging.getLogger("ml-tools")
+
+# Model of the current worker process, loaded by the pool initializer.
+_ARTIFACT: Optional[model_store.ModelArtifact] = None
+
+
+def _is_parquet(path: str) -> bool:
+    return path.endswith((".parquet", ".pq"))
+
+
+def read_chunks(path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Reads a csv or parquet file by chunks of rows."""
+    if not _is_parquet(path):
+        yield from pd.read_csv(path, chunksize=chunk_size)
+        return
+
+    # Parquet support is optional, pyarrow is installed with the parquet extra.
+    import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+        yield batch.to_pandas()
+
+
+class ScoreWriter:
+    """Writes the scored chunks to a csv or parquet file, in the order received."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._parquet_writer = None
+        self._header = True
+
+    def write(self, scored: pd.DataFrame) -> None:
+        """Appends a scored chunk to the file."""
+        if not _is_parquet(self.path):
+            mode = "w" if self._header else "a"
+            scored.to_csv(self.path, index=False, header=self._header, mode=mode)
+            self._header = False
+            return
+
+        import pyarrow as pa  # pylint: disable=import-outside-toplevel
+        import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+        table = pa.Table.from_pandas(scored, preserve_index=False)
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+        self._parquet_writer.write_table(table)
+
+    def close(self) -> None:
+        """Finishes the file."""
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+
+def _load_worker_model(version: Optional[str], model_dir: str) -> None:
+    global _ARTIFACT
+    _ARTIFACT = model_store.load_artifact(version, model_dir)
+    # The pool already uses every core, sklearn must not add threads.
+    _ARTIFACT.model.set_params(n_jobs=1)
+
+
+def score_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Scores a chunk with the model of the worker, keeps the ids if present."""
+    matrix = _ARTIFACT.preprocessor.transform(chunk)
+    scores = ml_tools.predict_batch(
+        _ARTIFACT.model, matrix, _ARTIFACT.features, len(matrix)
+    )
+    scored = pd.DataFrame({"score": scores}, index=chunk.index)
+    if "SK_ID_CURR" in chunk:
+        scored.insert(0, "SK_ID_CURR", chunk.SK_ID_CURR.astype(np.int64))
+    return scored
+
+
+def score_file(  # pylint: disable=too-many-arguments
+    input_path: str,
+    output_path: str,
+    *,
+    workers: Optional[int] = None,
+    chunk_size: int = 50_000,
+    version: Optional[str] = None,
+    model_dir: Optional[str] = None,
+) -> int:
+    """Scores every row of the input file and returns the number of rows.
+
+    At most two chunks per worker are read ahead, so memory does not grow with the
+    file size.
+    """
+    workers = workers or os.cpu_count() or 1
+    model_dir = model_dir or model_store.MODEL_DIR
+    writer = ScoreWriter(output_path)
+    pending: Deque[Future] = deque()
+    rows = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(
+        workers, initializer=_load_worker_model, initargs=(version, model_dir)
+    ) as pool:
+        try:
+            for chunk in read_chunks(input_path, chunk_size):
+                pending.append(pool.submit(score_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    scored = pending.popleft().result()
+                    writer.write(scored)
+                    rows += len(scored)
+            while pending:
+                scored = pending.popleft().result()
+                writer.write(scored)
+                rows += len(scored)
+        finally:
+            writer.close()
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "Scored %s rows in %.1fs with %s workers, %.0f rows/s",
+        rows,
+        elapsed,
+        workers,
+        rows / elapsed if elapsed else 0.0,
+    )
+    return rows
+
+
+def main(args: Optional[List[str]] = None):
+    """Command line entry point to score a customers file."""
+    parser = argparse.ArgumentParser(description="Score a customers file.")
+    parser.add_argument("input", help="csv or parquet file with the model features")
+    parser.add_argument("output", help="csv or parquet file to write the scores to")
+    parser.add_argument("--workers", type=int, help="processes, all cores if not set")
+    parser.add_argument("--chunk-size", type=int, default=50_000)
+    parser.add_argument("--model-version", help="latest version if not set")
+    parser.add_argument("--model-dir", default=model_store.MODEL_DIR)
+    options = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    score_file(
+        options.input,
+        options.output,
+        workers=options.workers,
+        chunk_size=options.chunk_size,
+        version=options.model_version,
+        model_dir=options.model_dir,
+    )
+
+
+if __name__ == "__main__":
+    main()
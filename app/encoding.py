@@ -0,0 +1,101 @@
+"""This module encodes the API responses.
+
+JSON is written with orjson, which serializes dicts, lists and NumPy arrays natively
+and much faster than the standard library. Bulk endpoints can also answer in the
+Arrow IPC stream format when the client accepts it, a compact binary columnar format
+read without parsing by pandas and most data tools. Arrow needs the optional
+pyarrow package, installed with the arrow extra.
+"""
+from __future__ import annotations
+
+from typing import Any
+
+import orjson
+import pandas as pd
+
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+
+def dumps(content: Any) -> bytes:
+    """Serializes to JSON, NumPy arrays and non string keys included."""
+    return orjson.dumps(
+        content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    )
+
+
+def loads(data: bytes) -> Any:
+    """Parses JSON, ValueError if it is not valid."""
+    return orjson.loads(data)
+
+
+def arrow_available() -> bool:
+    """Whether the Arrow format can be produced."""
+    try:
+        import pyarrow  # pylint: disable=import-outside-toplevel, unused-import
+    except ImportError:
+        return False
+    return True
+
+
+def wants_arrow(accept: str) -> bool:
+    """Whether an Accept header asks for the Arrow stream format."""
+    return ARROW_STREAM in accept
+
+
+class _Chunks:
+    """File like sink keeping what was written until it is taken."""
+
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        """Keeps a copy of the data, Arrow may reuse its buffer."""
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        """Nothing is buffered."""
+
+    def close(self) -> None:
+        """Marks the sink closed."""
+        self.closed = True
+
+    def take(self) -> bytes:
+        """Returns what was written since the last call."""
+        data = b"".join(self.parts)
+        self.parts.clear()
+        return data
+
+
+class ArrowStream:
+    """Encodes data frames with the same columns as one Arrow IPC stream, the bytes
+    of every frame are returned as soon as it is written.
+    """
+
+    def __init__(self):
+        self._sink = _Chunks()
+        self._writer = None
+
+    def write(self, frame: pd.DataFrame) -> bytes:
+        """Encodes a frame, the first one also sends the schema."""
+        # pylint: disable=import-outside-toplevel
+        import pyarrow as pa
+
+        batch = pa.RecordBatch.from_pandas(frame, preserve_index=False)
+        if self._writer is None:
+            self._writer = pa.ipc.new_stream(self._sink, batch.schema)
+        self._writer.write_batch(batch)
+        return self._sink.take()
+
+    def close(self) -> bytes:
+        """Returns the end of stream marker."""
+        if self._writer is not None:
+            self._writer.close()
+        return self._sink.take()
+
+
+def to_arrow(frame: pd.DataFrame) -> bytes:
+    """Encodes one data frame as an Arrow IPC stream."""
+    stream = ArrowStream()
+    return stream.write(frame) + stream.close()
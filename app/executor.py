@@ -0,0 +1,94 @@
+"""This module runs the blocking model and pandas work of the server away from the
+asyncio event loop, so one slow call does not stall the other requests.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+@dataclass
+class QueueStats:
+    """Usage counters of one kind of operation."""
+
+    limit: int
+    queued: int = 0
+    running: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class Executor:
+    """Bounded thread pool with a concurrency limit per operation name.
+
+    Threads are used rather than processes because sklearn and pandas release the GIL
+    in their heavy loops and the model can then stay loaded once per worker. Calls
+    above the limit of their operation wait on the event loop, the number of waiting
+    calls is reported as the queue depth.
+
+    The slow background operations run on a pool of their own, with a thread for
+    each call their limits allow, so they never hold the threads of the requests.
+    """
+
+    def __init__(
+        self,
+        limits: Dict[str, int],
+        max_workers: Optional[int] = None,
+        default_limit: int = 1,
+        background: Iterable[str] = (),
+    ):
+        self._pool = ThreadPoolExecutor(
+            max_workers or os.cpu_count(), thread_name_prefix="ml-work"
+        )
+        self._background = set(background)
+        self._background_pool = ThreadPoolExecutor(
+            max(1, sum(limits.get(name, default_limit) for name in self._background)),
+            thread_name_prefix="ml-background",
+        )
+        self._default_limit = default_limit
+        self.stats: Dict[str, QueueStats] = {
+            name: QueueStats(limit) for name, limit in limits.items()
+        }
+        # Created on first use so they belong to the running loop.
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def _semaphore(self, name: str) -> asyncio.Semaphore:
+        if name not in self._semaphores:
+            stats = self.stats.setdefault(name, QueueStats(self._default_limit))
+            self._semaphores[name] = asyncio.Semaphore(stats.limit)
+        return self._semaphores[name]
+
+    async def run(self, name: str, func: Callable, *args, **kwargs) -> Any:
+        """Runs func in the pool once a slot of the operation is free."""
+        semaphore = self._semaphore(name)
+        stats = self.stats[name]
+        pool = self._background_pool if name in self._background else self._pool
+
+        stats.queued += 1
+        async with semaphore:
+            stats.queued -= 1
+            stats.running += 1
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    pool, functools.partial(func, *args, **kwargs)
+                )
+            except Exception:
+                stats.failed += 1
+                raise
+            finally:
+                stats.running -= 1
+        stats.completed += 1
+        return result
+
+    def metrics(self) -> Dict[str, Dict[str, int]]:
+        """Returns the counters of every operation."""
+        return {name: asdict(stats) for name, stats in self.stats.items()}
+
+    def shutdown(self) -> None:
+        """Waits for the running calls and stops the threads."""
+        self._pool.shutdown(wait=True)
+        self._background_pool.shutdown(wait=True)
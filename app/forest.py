@@ -0,0 +1,130 @@
+"""This module exports a trained random forest to flat NumPy arrays and evaluates it
+without going through sklearn, which is much faster for a handful of rows.
+"""
+from __future__ import annotations
+
+from typing import List, Tuple
+
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+
+
+class FlatForest:
+    """All the trees of a forest stored in contiguous arrays indexed by node.
+
+    Leaves point to themselves, so every row can walk max depth steps in every tree
+    at once. Leaf values hold the class probabilities of the tree, normalized like
+    sklearn does, and are summed in the estimators order then divided by the number
+    of trees so the probabilities are identical to ``predict_proba``.
+    """
+
+    # pylint: disable=too-many-arguments, too-many-instance-attributes
+    def __init__(
+        self,
+        *,
+        feature: np.ndarray,
+        threshold: np.ndarray,
+        left: np.ndarray,
+        right: np.ndarray,
+        proba: np.ndarray,
+        roots: np.ndarray,
+        depth: int,
+    ):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.proba = proba
+        self.roots = roots
+        self.depth = depth
+        self.leaf = left == np.arange(len(left))
+
+    @classmethod
+    def from_sklearn(cls, model: RandomForestClassifier) -> FlatForest:
+        """Flattens the trees of a fitted single output forest."""
+        features: List[np.ndarray] = []
+        thresholds: List[np.ndarray] = []
+        lefts: List[np.ndarray] = []
+        rights: List[np.ndarray] = []
+        probas: List[np.ndarray] = []
+        roots: List[int] = []
+        offset = 0
+
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            nodes = np.arange(tree.node_count)
+            leaf = tree.children_left == -1
+
+            value = tree.value[:, 0, : model.n_classes_]
+            normalizer = value.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+
+            features.append(np.where(leaf, 0, tree.feature))
+            thresholds.append(tree.threshold)
+            lefts.append(np.where(leaf, nodes, tree.children_left) + offset)
+            rights.append(np.where(leaf, nodes, tree.children_right) + offset)
+            probas.append(value / normalizer)
+            roots.append(offset)
+            offset += tree.node_count
+
+        return cls(
+            feature=np.concatenate(features).astype(np.intp),
+            threshold=np.concatenate(thresholds),
+            left=np.concatenate(lefts).astype(np.intp),
+            right=np.concatenate(rights).astype(np.intp),
+            proba=np.concatenate(probas),
+            roots=np.array(roots, dtype=np.intp),
+            depth=max(estimator.tree_.max_depth for estimator in model.estimators_),
+        )
+
+    def apply(self, matrix: np.ndarray) -> np.ndarray:
+        """Returns the leaf reached by every row in every tree."""
+        matrix = np.asarray(matrix, dtype=np.float32)
+        rows = np.arange(len(matrix))[:, np.newaxis]
+        nodes = np.repeat(self.roots[np.newaxis, :], len(matrix), axis=0)
+        for step in range(self.depth):
+            # Most paths are much shorter than the deepest one.
+            if step % 4 == 0 and self.leaf[nodes].all():
+                break
+            go_left = matrix[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return nodes
+
+    def explain(self, matrix: np.ndarray) -> Tuple[float, np.ndarray]:
+        """Splits the class 1 probability of every row into per feature parts.
+
+        Every split on the path of a row moves its value from the node one to the
+        child one, the change is credited to the feature of the split. Returns the
+        mean value of the roots and the contributions matrix, rows by features, so
+        bias plus the row sum equals ``predict_proba(matrix)[:, 1]``.
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        n_rows, n_features = matrix.shape
+        value = self.proba[:, 1]
+        rows = np.arange(n_rows)[:, np.newaxis]
+        nodes = np.repeat(self.roots[np.newaxis, :], n_rows, axis=0)
+        contributions = np.zeros(n_rows * n_features)
+        for step in range(self.depth):
+            if step % 4 == 0 and self.leaf[nodes].all():
+                break
+            feature = self.feature[nodes]
+            go_left = matrix[rows, feature] <= self.threshold[nodes]
+            children = np.where(go_left, self.left[nodes], self.right[nodes])
+            # Leaves point to themselves and add nothing.
+            contributions += np.bincount(
+                (rows * n_features + feature).ravel(),
+                weights=(value[children] - value[nodes]).ravel(),
+                minlength=len(contributions),
+            )
+            nodes = children
+        bias = float(value[self.roots].mean())
+        return bias, contributions.reshape(n_rows, n_features) / len(self.roots)
+
+    def predict_proba(self, matrix: np.ndarray) -> np.ndarray:
+        """Returns the class probabilities of every row."""
+        leaves = self.apply(matrix)
+        proba = np.zeros((len(leaves), self.proba.shape[1]))
+        for tree in range(len(self.roots)):
+            proba += self.proba[leaves[:, tree]]
+        proba /= len(self.roots)
+        return proba
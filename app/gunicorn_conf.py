@@ -0,0 +1,81 @@
+"""Gunicorn settings of the production server, started from the project root with:
+
+    gunicorn -c app/gunicorn_conf.py app.prediction_server:app
+
+The app is imported once in the master, which loads the model and the customers
+before forking the uvicorn workers. The workers share these pages as long as they
+only read them, so memory does not grow with every worker and a new worker starts
+without reading the data again. Values come from ServerSettings and can be set with
+environment variables.
+
+Workers are recycled after MAX_REQUESTS requests: a worker stops accepting
+connections, finishes the requests in flight within GRACEFUL_TIMEOUT seconds, writes
+its pending decisions and is replaced by a new fork of the master. ``kill -HUP``
+replaces all the workers the same way, the code is only reloaded by a restart.
+
+Every worker keeps its own metrics, they write them to METRICS_DIR, a temporary
+folder if not set, so /metrics returns those of all the workers whichever answers.
+"""
+import gc
+import glob
+import math
+import os
+import tempfile
+
+from app.metrics import EXPORT_SUFFIX
+from app.settings import server_conf
+
+
+def worker_count(cpus: int, request_cpu_ms: float, request_wall_ms: float) -> int:
+    """Workers needed to keep every core busy.
+
+    A worker only uses the CPU for request_cpu_ms of every request_wall_ms, the rest
+    it waits on the disk, so more workers than cores are needed when requests wait.
+    Capped at the usual gunicorn maximum of two per core plus one.
+    """
+    busy = min(max(request_cpu_ms / request_wall_ms, 0.1), 1.0)
+    return max(1, min(math.ceil(cpus / busy), 2 * cpus + 1))
+
+
+def when_ready(server):  # pylint: disable=unused-argument
+    """Preloads the data in the master once the app is imported, before the fork."""
+    # pylint: disable=import-outside-toplevel
+    from app import prediction_server
+
+    prediction_server.preload()
+    # The collector would write to the pages of every object it visits in the
+    # workers, freezing them keeps these pages shared.
+    gc.freeze()
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """Creates the metrics folder, a temporary one if METRICS_DIR is not set, and
+    removes the metrics files of the workers of a previous run.
+    """
+    if not server_conf.METRICS_DIR:
+        # Read by the workers forked from this process.
+        setattr(server_conf, "METRICS_DIR", tempfile.mkdtemp(prefix="risk-metrics-"))
+    os.makedirs(server_conf.METRICS_DIR, exist_ok=True)
+    for path in glob.glob(os.path.join(server_conf.METRICS_DIR, f"*{EXPORT_SUFFIX}")):
+        os.remove(path)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Removes the metrics file of a stopped worker, its series end with it."""
+    try:
+        os.remove(os.path.join(server_conf.METRICS_DIR, f"{worker.pid}{EXPORT_SUFFIX}"))
+    except FileNotFoundError:
+        pass
+
+
+# Gunicorn reads these lower case names.
+# pylint: disable=invalid-name
+bind = server_conf.BIND
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+workers = server_conf.WORKERS or worker_count(
+    os.cpu_count() or 1, server_conf.REQUEST_CPU_MS, server_conf.REQUEST_WALL_MS
+)
+max_requests = server_conf.MAX_REQUESTS
+max_requests_jitter = server_conf.MAX_REQUESTS_JITTER
+graceful_timeout = server_conf.GRACEFUL_TIMEOUT
@@ -0,0 +1,283 @@
+"""This module contains the measurement tools used by the server.
+
+Metrics are kept in a registry exported in the Prometheus text format, so no client
+library is needed. Each process has its own registry, the processes of a multi worker
+server write their export to a shared folder and any of them merges the files.
+"""
+from __future__ import annotations
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+
+
+class Histogram:
+    """Histogram with fixed bucket upper bounds, counts are cumulative on export in
+    the Prometheus way.
+    """
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        """Records one value."""
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def to_dict(self) -> Dict[str, Union[float, Dict[str, int]]]:
+        """Returns the cumulative bucket counts with the sum and count of values."""
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.buckets + [float("inf")], self._counts):
+            cumulative += count
+            buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class Gauge:
+    """Value that goes up and down, or read from a function when exported."""
+
+    def __init__(self, func: Optional[Callable[[], float]] = None):
+        self.func = func
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        """Adds to the value, counters only use this."""
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        """Subtracts from the value."""
+        self.inc(-amount)
+
+    def set(self, value: float) -> None:
+        """Replaces the value."""
+        with self._lock:
+            self._value = value
+
+    @property
+    def value(self) -> float:
+        """Current value."""
+        return self.func() if self.func else self._value
+
+
+Labels = Tuple[Tuple[str, str], ...]
+Metric = Union[Gauge, Histogram]
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    pairs = [f'{key}="{value}"' for key, value in labels]
+    pairs += [extra] if extra else []
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Registry:
+    """Named metrics with labels, each name has one type and one help text."""
+
+    def __init__(self):
+        self._families: Dict[str, Tuple[str, str, Dict[Labels, Metric]]] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name: str, kind: str, description: str, labels, factory) -> Metric:
+        key: Labels = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            family = self._families.setdefault(name, (kind, description, {}))
+            if key not in family[2]:
+                family[2][key] = factory()
+            return family[2][key]
+
+    def counter(
+        self,
+        name: str,
+        description: str,
+        func: Optional[Callable[[], float]] = None,
+        **labels,
+    ) -> Gauge:
+        """Returns the counter with these labels, created on first use."""
+        return self._get(name, "counter", description, labels, lambda: Gauge(func))
+
+    def gauge(
+        self,
+        name: str,
+        description: str,
+        func: Optional[Callable[[], float]] = None,
+        **labels,
+    ) -> Gauge:
+        """Returns the gauge with these labels, created on first use."""
+        return self._get(name, "gauge", description, labels, lambda: Gauge(func))
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        **labels,
+    ) -> Histogram:
+        """Returns the histogram with these labels, created on first use."""
+        return self._get(
+            name, "histogram", description, labels, lambda: Histogram(buckets)
+        )
+
+    def register(self, name: str, description: str, metric: Metric, **labels):
+        """Adds a metric created elsewhere."""
+        kind = "histogram" if isinstance(metric, Histogram) else "gauge"
+        self._get(name, kind, description, labels, lambda: metric)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """Times a block into the stage duration histogram."""
+        histogram = self.histogram(
+            "risk_stage_duration_seconds", "Duration of internal stages.", stage=stage
+        )
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            families = [
+                (name, kind, description, list(metrics.items()))
+                for name, (kind, description, metrics) in self._families.items()
+            ]
+        lines: List[str] = []
+        for name, kind, description, metrics in families:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            for labels, metric in metrics:
+                if isinstance(metric, Histogram):
+                    exported = metric.to_dict()
+                    for bound, count in exported["buckets"].items():
+                        bucket = _format_labels(labels, f'le="{bound}"')
+                        lines.append(f"{name}_bucket{bucket} {count}")
+                    lines.append(
+                        f"{name}_sum{_format_labels(labels)} {exported['sum']}"
+                    )
+                    lines.append(
+                        f"{name}_count{_format_labels(labels)} {exported['count']}"
+                    )
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Writes the export to a file, replaced at once so it is never read partly
+        written.
+        """
+        with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+            file.write(self.render())
+        os.replace(f"{path}.tmp", path)
+
+
+EXPORT_SUFFIX = ".prom"
+
+
+def read_exports(directory: str) -> Dict[str, str]:
+    """Reads the exports written to a folder, by name without the suffix."""
+    exports = {}
+    for name in os.listdir(directory):
+        if not name.endswith(EXPORT_SUFFIX):
+            continue
+        try:
+            with open(os.path.join(directory, name), encoding="utf-8") as file:
+                exports[name[: -len(EXPORT_SUFFIX)]] = file.read()
+        except FileNotFoundError:
+            # Removed since, its process exited.
+            continue
+    return exports
+
+
+def _add_label(sample: str, label: str) -> str:
+    metric, value = sample.rsplit(" ", 1)
+    if metric.endswith("}"):
+        return f"{metric[:-1]},{label}}} {value}"
+    return f"{metric}{{{label}}} {value}"
+
+
+def merge_exports(exports: Dict[str, str], label: str = "worker") -> str:
+    """Merges the exports of several processes, every sample gets a label with the
+    name of its export so each family is listed once with the series of all the
+    processes. Sum them by the other labels to get the server totals.
+    """
+    headers: Dict[str, List[str]] = {}
+    samples: Dict[str, List[str]] = {}
+    for key, text in sorted(exports.items()):
+        name = ""
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                name = line.split(" ", 3)[2]
+                headers.setdefault(name, [])
+                samples.setdefault(name, [])
+            if line.startswith("#"):
+                if len(headers[name]) < 2:
+                    headers[name].append(line)
+            elif line:
+                samples[name].append(_add_label(line, f'{label}="{key}"'))
+    lines = [
+        line for name, header in headers.items() for line in header + samples[name]
+    ]
+    return "\n".join(lines) + "\n"
+
+
+class RouteMetricsMiddleware:
+    """ASGI middleware counting the requests in flight and timing them by route
+    template and status, unknown paths are reported as one route.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, app, registry: Registry, routes: Sequence):
+        self.app = app
+        self.registry = registry
+        self.routes = routes
+
+    def _route(self, scope) -> str:
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = self._route(scope)
+        in_flight = self.registry.gauge(
+            "risk_http_requests_in_flight", "Requests being served.", route=route
+        )
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_flight.dec()
+            self.registry.histogram(
+                "risk_http_request_duration_seconds",
+                "Latency of the HTTP requests.",
+                route=route,
+                method=scope["method"],
+                status=status["code"],
+            ).observe(time.perf_counter() - start)
@@ -1,13 +1,17 @@
 """This module contains all that is needed to preform model tasks."""
 from __future__ import annotations
 
+import hashlib
 import logging
-from typing import TYPE_CHECKING, Tuple
+import threading
+from collections import deque
+from typing import TYPE_CHECKING, Any, Deque, Dict, Iterator, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.impute import SimpleImputer
+
+from app import encoding, storage
 
 if TYPE_CHECKING:
     from app.prediction_server import Customer
@@ -15,33 +19,218 @@ if TYPE_CHECKING:
 logger = logging.getLogger("ml-tools")
 
 
-def load_data() -> Tuple[pd.DataFrame, pd.DataFrame]:
-    """Reads the base features working file"""
-    try:
-        train = pd.read_csv("app/data/train.csv")
-        labels = pd.read_csv("app/data/labels.csv")
-        return train, labels
-    except FileNotFoundError as error:
-        logger.error("Cannot read features file, ERROR %s: ", error)
-        raise
+class CustomerStore:
+    """Process resident copy of the customers dataset indexed by SK_ID_CURR.
+
+    The dataset is loaded once and kept as a single float matrix, a hash index maps
+    every customer id to the positions of its rows so lookups do not scan the data.
+    A customer may have several rows, one per saved application.
+
+    Rows saved by other processes are added with sync from the end of the decision
+    log, the rows appended by this process are recognized when they are read back.
+    """
+
+    def __init__(
+        self, data: pd.DataFrame, log_position: Optional[Tuple[int, int]] = None
+    ):
+        self.columns: List[str] = list(data.columns)
+        # Room left for the appended rows, so the first one does not copy the whole
+        # matrix and the pages shared with the gunicorn master stay shared.
+        self._size = len(data)
+        self._values = np.empty(
+            (self._size + max(1024, self._size // 8), len(self.columns))
+        )
+        for position, col in enumerate(self.columns):
+            self._values[: self._size, position] = data[col].to_numpy()
+        self._index: Dict[int, List[int]] = {
+            int(customer_id): list(positions)
+            for customer_id, positions in data.groupby("SK_ID_CURR").indices.items()
+        }
+        self._lock = threading.Lock()
+        # Position in the decision log of the next rows to sync.
+        self.log_position = log_position
+        # Rows appended here and not read back from the decision log yet.
+        self._unsaved: Deque[np.ndarray] = deque()
+
+    @classmethod
+    def from_disk(cls) -> CustomerStore:
+        """Builds the store from the data files."""
+        return cls(*storage.read_customers_at())
+
+    def __contains__(self, customer_id: float) -> bool:
+        return int(customer_id) in self._index
+
+    def __len__(self) -> int:
+        return self._size
+
+    def get(self, customer_id: int) -> List[Dict[str, float]]:
+        """Returns all the rows saved for a customer, oldest first.
+
+        The data files hold float32 values, they are returned as the shortest
+        decimal of their float32, 0.1 and not 0.10000000149011612.
+        """
+        positions = self._index.get(int(customer_id))
+        if positions is None:
+            raise ValueError("Customer ID not found")
+
+        records = []
+        for row in self._values[positions].astype(np.float32):
+            record = {
+                col: None if np.isnan(value) else float(str(value))
+                for col, value in zip(self.columns, row)
+            }
+            record["SK_ID_CURR"] = int(customer_id)
+            records.append(record)
+        return records
+
+    def to_pandas(self) -> pd.DataFrame:
+        """Returns the stored rows as a data frame sharing the store memory."""
+        return pd.DataFrame(self._values[: self._size], columns=self.columns)
+
+    def iter_chunks(
+        self,
+        chunk_size: int = 10_000,
+        min_id: Optional[int] = None,
+        max_id: Optional[int] = None,
+        target: Optional[float] = None,
+    ) -> Iterator[pd.DataFrame]:
+        """Yields the stored rows by chunks, only those with an id in the inclusive
+        range and the given TARGET if any. Rows added meanwhile are not included.
+        """
+        with self._lock:
+            values, size = self._values, self._size
+        ids = self.columns.index("SK_ID_CURR")
+        labels = self.columns.index("TARGET")
+        for start in range(0, size, chunk_size):
+            chunk = values[start : min(start + chunk_size, size)]
+            keep = np.ones(len(chunk), dtype=bool)
+            if min_id is not None:
+                keep &= chunk[:, ids] >= min_id
+            if max_id is not None:
+                keep &= chunk[:, ids] <= max_id
+            if target is not None:
+                keep &= chunk[:, labels] == target
+            if keep.any():
+                yield pd.DataFrame(chunk[keep], columns=self.columns)
+
+    def append(self, customer: Dict[str, Optional[float]]) -> None:
+        """Adds a customer row to the store without reloading the data files."""
+        row = np.array(
+            [
+                np.nan if customer[col] is None else customer[col]
+                for col in self.columns
+            ],
+            dtype=np.float64,
+        )
+        with self._lock:
+            self._add_row(row)
+            self._unsaved.append(row)
+
+    def _add_row(self, row: np.ndarray) -> None:
+        if self._size == len(self._values):
+            extra = np.empty((max(1024, self._size // 8), len(self.columns)))
+            self._values = np.concatenate([self._values, extra])
+        self._values[self._size] = row
+        self._index.setdefault(int(row[self.columns.index("SK_ID_CURR")]), []).append(
+            self._size
+        )
+        self._size += 1
+
+    def sync(
+        self, rows: pd.DataFrame, log_position: Tuple[int, int]
+    ) -> List[Dict[str, Optional[float]]]:
+        """Adds the rows saved by other processes, read from the decision log up to
+        log_position. Returns the added customers.
+
+        A process writes its rows in the order it appended them, so the next row of
+        this process to be read back is always the oldest unsaved one. The rows are
+        given the types of the data files, float32 mostly, and compared at that
+        precision.
+        """
+        added = []
+        with self._lock:
+            if not rows.empty:
+                rows = rows[self.columns].astype(storage.schema(self.columns))
+            for row in rows.to_numpy(np.float64):
+                if self._unsaved and np.array_equal(
+                    row.astype(np.float32),
+                    self._unsaved[0].astype(np.float32),
+                    equal_nan=True,
+                ):
+                    self._unsaved.popleft()
+                    continue
+                self._add_row(row)
+                added.append(
+                    {
+                        col: None if np.isnan(value) else float(value)
+                        for col, value in zip(self.columns, row)
+                    }
+                )
+            self.log_position = log_position
+        return added
+
+
+def load_data(
+    columns: Optional[List[str]] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Reads the base features working file and the labels.
+
+    Only the given feature columns are read if any, labels are always returned.
+    """
+    data = load_and_concatenate_data(None if columns is None else columns + ["TARGET"])
+    # Popped so the features are not copied.
+    target = data.pop("TARGET").to_frame()
+    return data, target
 
 
-def load_and_concatenate_data() -> pd.DataFrame:
+def load_and_concatenate_data(columns: Optional[List[str]] = None) -> pd.DataFrame:
     """lods the data and joins them in a single data frame."""
-    train, target = load_data()
-    train["TARGET"] = target.values
-    return train
+    return storage.read_customers(columns)
+
+
+class Preprocessor:
+    """Turns customers into the float32 matrix the model is trained and served on.
+
+    The id and label are dropped, the features put in the training order and the
+    missing values filled with the training medians, all in one vectorized step on
+    the whole matrix. It is fitted with the model and saved with it, so training and
+    serving go through the same transform.
+    """
 
+    DROPPED_COLUMNS = ["SK_ID_CURR", "TARGET"]
 
-def prepare_train_data(train: pd.DataFrame) -> pd.DataFrame:
-    """Prepares data for training the model."""
-    train.drop(["SK_ID_CURR"], axis=1, inplace=True)
+    def __init__(self, features: List[str], medians: np.ndarray):
+        self.features = features
+        self.medians = np.asarray(medians, dtype=np.float32)
 
-    imp = SimpleImputer(missing_values=np.nan, strategy="median")
-    imp.set_output(transform="pandas")
-    train = imp.fit_transform(train)
+    @classmethod
+    def fit(cls, data: pd.DataFrame) -> Preprocessor:
+        """Learns the features order and medians from the training data."""
+        features = [col for col in data.columns if col not in cls.DROPPED_COLUMNS]
+        return cls(features, data[features].median().to_numpy())
 
-    return train
+    def impute(self, matrix: np.ndarray) -> np.ndarray:
+        """Fills the missing values of a matrix in the features order, in place."""
+        np.copyto(matrix, self.medians, where=np.isnan(matrix))
+        return matrix
+
+    def transform(self, data: pd.DataFrame) -> np.ndarray:
+        """Returns the model matrix of a data frame holding at least the features."""
+        return self.impute(data[self.features].to_numpy(dtype=np.float32))
+
+    def transform_customers(self, customers: List[Customer]) -> np.ndarray:
+        """Returns the model matrix of customers sent to the server."""
+        return self.impute(customers_to_matrix(customers, self.features))
+
+
+def prepare_train_data(train: pd.DataFrame) -> Tuple[pd.DataFrame, Preprocessor]:
+    """Prepares data for training the model, returns it with the fitted
+    preprocessor.
+    """
+    preprocessor = Preprocessor.fit(train)
+    train = pd.DataFrame(preprocessor.transform(train), columns=preprocessor.features)
+
+    return train, preprocessor
 
 
 def prepare_predict_data(customer: pd.DataFrame) -> pd.DataFrame:
@@ -50,65 +239,218 @@ def prepare_predict_data(customer: pd.DataFrame) -> pd.DataFrame:
     return customer
 
 
-def train_model(data: pd.DataFrame, target: pd.DataFrame) -> RandomForestClassifier:
-    """Trains a random forest model and returns it for further operations"""
-    random_forest = RandomForestClassifier(n_estimators=5, random_state=150, n_jobs=-1)
+def customers_to_matrix(customers: List[Customer], features: List[str]) -> np.ndarray:
+    """Builds one contiguous float32 matrix from customers in the features order,
+    missing values are NaN.
+    """
+    matrix = np.empty((len(customers), len(features)), dtype=np.float32)
+    for row, customer in enumerate(customers):
+        values = [getattr(customer, feature) for feature in features]
+        matrix[row] = [np.nan if value is None else value for value in values]
+    return matrix
+
+
+def predict_batch(
+    model: RandomForestClassifier,
+    matrix: np.ndarray,
+    features: List[str],
+    chunk_size: int = 10_000,
+) -> np.ndarray:
+    """Returns the risk of every row, predicting by chunks to bound memory use."""
+    scores = np.empty(len(matrix), dtype=np.float64)
+    for start in range(0, len(matrix), chunk_size):
+        chunk = pd.DataFrame(matrix[start : start + chunk_size], columns=features)
+        scores[start : start + chunk_size] = model.predict_proba(chunk)[:, 1]
+    return scores
+
+
+# Forest parameters used when none are tuned.
+FOREST_PARAMS = {"n_estimators": 5, "random_state": 150, "n_jobs": -1}
+
+
+def train_model(
+    data: pd.DataFrame, target: pd.DataFrame, params: Optional[Dict[str, Any]] = None
+) -> RandomForestClassifier:
+    """Trains a random forest model and returns it for further operations.
+
+    The given params replace the default forest parameters.
+    """
+    random_forest = RandomForestClassifier(**{**FOREST_PARAMS, **(params or {})})
     random_forest.fit(data, target)
 
     return random_forest
 
 
-def append_new_customer(customer: Customer):
+def append_new_customer(
+    customer: Customer,
+    store: Optional[CustomerStore] = None,
+    writer: Optional[storage.DecisionWriter] = None,
+):
     """Appends the new customer to the existing dataset.
     The dictionary must have all the columns of the dataset.
-    """
-    customer_df = customer.to_pandas()
 
-    train, _ = load_data()
+    When a store is given the id is checked against it and the new row is added to
+    it, so the data files are only written, never re-read. When a writer is given
+    the decision is written in the background.
+    """
+    if store is None:
+        store = CustomerStore.from_disk()
 
-    if customer.SK_ID_CURR not in train.SK_ID_CURRENT.values:
+    if customer.SK_ID_CURR not in store:
         raise ValueError("Customer ID not found")
 
-    customer_df[customer_df[customer_df.columns != "TARGET"]].to_csv(
-        "app/data/train.csv", index=False, header=False, index_label=False, mode="a"
-    )
-    customer_df[customer_df[customer_df.columns == "TARGET"]].to_csv(
-        "app/data/labels.csv", index=False, header=False, index_label=False, mode="a"
-    )
+    record = customer.dict()
+    record.update(SK_ID_CURR=int(customer.SK_ID_CURR), TARGET=float(customer.TARGET))
+    # Added to the store first so it is known as this process' row when the store
+    # reads the files again.
+    store.append(record)
+    if writer is None:
+        storage.DecisionLog().append([record])
+    else:
+        writer.submit(record)
 
 
-def train_and_return() -> RandomForestClassifier:
-    """Train model with data an return model"""
+def train_pipeline() -> Tuple[RandomForestClassifier, Preprocessor]:
+    """Train model with data and return it with the preprocessor fitted on the
+    data.
+    """
     train, target = load_data()
-    train = prepare_train_data(train)
+    train, preprocessor = prepare_train_data(train)
 
-    return train_model(train, target)
+    return train_model(train, target), preprocessor
 
 
-def get_customer(customer_id: int):
+def train_and_return() -> RandomForestClassifier:
+    """Train model with data an return model"""
+    model, _ = train_pipeline()
+    return model
+
+
+def get_customer(customer_id: int, store: Optional[CustomerStore] = None):
     """Gets à customer from SK_ID_CURR identification."""
-    train = load_and_concatenate_data()
+    if store is None:
+        store = CustomerStore.from_disk()
 
-    if customer_id not in train.SK_ID_CURR.values:
-        raise ValueError("Customer ID not found")
+    return store.get(customer_id)
+
+
+def _float32_list(values: np.ndarray) -> List[float]:
+    # Means rounded to the float32 precision of the data, the sums are not made in
+    # the same order by every worker and must still give the same payload.
+    return [float(str(value)) for value in values.astype(np.float32)]
+
+
+class AcceptedStats:
+    """Statistics of the customers with granted credits (TARGET 0) used by graphs.
+
+    The aggregates are computed once from the data and then updated with every new
+    accepted customer, the JSON payload and its ETag are rebuilt on each change.
+    """
 
-    customer_data = train[train.SK_ID_CURR == customer_id]
-    return customer_data.to_dict("r")
+    # pylint: disable=too-many-instance-attributes
+    COUNTED_COLUMNS = ["FLAG_OWN_CAR", "FLAG_OWN_REALTY", "CNT_CHILDREN"]
+
+    def __init__(self, data: pd.DataFrame):
+        accepted = data[data.TARGET == 0]
+        described = accepted.drop(
+            self.COUNTED_COLUMNS + ["SK_ID_CURR", "TARGET"], axis=1
+        )
+        self.columns: List[str] = list(described.columns)
+        self._count = described.count().to_numpy(dtype=np.float64)
+        self._sum = described.sum().to_numpy(dtype=np.float64)
+        self._min = described.min().to_numpy(dtype=np.float64)
+        self._max = described.max().to_numpy(dtype=np.float64)
+        self._counts: Dict[str, Dict[float, int]] = {
+            column: accepted[column].value_counts().to_dict()
+            for column in self.COUNTED_COLUMNS
+        }
+        self._lock = threading.Lock()
+        self.payload = b""
+        self.etag = ""
+        self.chart_payload = b""
+        self.chart_etag = ""
+        self._refresh()
+
+    def add(self, customer: Dict[str, Optional[float]]) -> None:
+        """Updates the statistics with a new customer if its credit was granted."""
+        if customer["TARGET"] != 0:
+            return
+
+        # At the float32 precision of the data files, like the rows read from them.
+        values = np.array(
+            [
+                np.nan if customer[col] is None else customer[col]
+                for col in self.columns
+            ],
+            dtype=np.float32,
+        ).astype(np.float64)
+        known = ~np.isnan(values)
+        with self._lock:
+            self._count += known
+            self._sum += np.where(known, values, 0)
+            self._min = np.fmin(self._min, values)
+            self._max = np.fmax(self._max, values)
+            for column in self.COUNTED_COLUMNS:
+                if customer[column] is not None:
+                    counts = self._counts[column]
+                    counts[customer[column]] = counts.get(customer[column], 0) + 1
+            self._refresh()
+
+    def to_list(self) -> List:
+        """Returns the min, mean and max description followed by the value counts,
+        every item in the pandas split orientation, a data frame is rebuilt with
+        ``pd.DataFrame(**item)``.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self._sum / self._count
+        description = {
+            "index": ["mean", "min", "max"],
+            "columns": self.columns,
+            "data": [_float32_list(mean), self._min.tolist(), self._max.tolist()],
+        }
+        concatenated_count = []
+        for column in self.COUNTED_COLUMNS:
+            values = sorted(self._counts[column])
+            concatenated_count.append(
+                {
+                    "index": [float(value) for value in values],
+                    "columns": [column],
+                    "data": [[self._counts[column][value]] for value in values],
+                }
+            )
+        return [description, concatenated_count]
+
+    def to_chart(self) -> Dict:
+        """Returns the statistics ready to draw: the accepted mean normalized
+        between the min and the max of every feature, the bounds to normalize the
+        customer with and the sorted value counts of the counted columns.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self._sum / self._count
+            scaled = np.nan_to_num((mean - self._min) / (self._max - self._min))
+        counts = {}
+        for column in self.COUNTED_COLUMNS:
+            values = sorted(self._counts[column])
+            counts[column] = {
+                "values": [float(value) for value in values],
+                "counts": [self._counts[column][value] for value in values],
+            }
+        return {
+            "features": self.columns,
+            "min": np.nan_to_num(self._min).tolist(),
+            "max": np.nan_to_num(self._max).tolist(),
+            "mean": _float32_list(np.nan_to_num(mean)),
+            "scaled_mean": _float32_list(scaled),
+            "counts": counts,
+        }
+
+    def _refresh(self) -> None:
+        self.payload = encoding.dumps(self.to_list())
+        self.etag = f'"{hashlib.sha256(self.payload).hexdigest()[:32]}"'
+        self.chart_payload = encoding.dumps(self.to_chart())
+        self.chart_etag = f'"{hashlib.sha256(self.chart_payload).hexdigest()[:32]}"'
 
 
 def get_general_data_description():
     """Gets general data statistics to produce explanatory graphs."""
-    data = load_and_concatenate_data()
-    cols_to_count = ["FLAG_OWN_CAR", "FLAG_OWN_REALTY", "CNT_CHILDREN"]
-    all_approved = data[data.TARGET == 0]
-    all_app_big = all_approved.drop(
-        cols_to_count + ["SK_ID_CURR", "TARGET"], axis=1
-    ).describe()
-    all_app_big = all_app_big.drop(["count", "std", "25%", "50%", "75%"], axis=0)
-    all_app_perc = all_approved[cols_to_count]
-    concatenated_count = []
-    for column in all_app_perc.columns:
-        concat = all_app_perc.groupby([column])[column].count().to_json(orient="split")
-        concatenated_count.append(concat)
-
-    return [all_app_big.to_json(orient="split"), concatenated_count]
+    return AcceptedStats(load_and_concatenate_data()).to_list()
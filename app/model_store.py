@@ -0,0 +1,399 @@
+"""This module persists trained models so the server never trains on a request.
+
+Every training run is saved as a versioned artifact holding the model and the fitted
+preprocessor with the feature order. The ``LATEST`` file points to the version served.
+Training jobs started by the server run in another process and report their
+progress in a status file read by every worker.
+
+The customers are only ever appended, so the number of rows a model was trained on
+is enough to know which rows it has not seen yet and to update it incrementally.
+"""
+from __future__ import annotations
+
+import argparse
+import copy
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass, field, fields
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import joblib
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+
+from app import encoding, ml_tools
+from app.forest import FlatForest
+
+logger = logging.getLogger("ml-tools")
+
+MODEL_DIR = "app/models"
+LATEST_FILE = "LATEST"
+JOBS_DIR = "jobs"
+TRAINING_LOCK = "training.lock"
+
+
+@dataclass
+class ModelArtifact:
+    """Everything needed to serve predictions from one training run."""
+
+    # pylint: disable=too-many-instance-attributes
+    model: RandomForestClassifier
+    preprocessor: ml_tools.Preprocessor
+    features: List[str]
+    version: str
+    created_at: str
+    forest: Optional[FlatForest] = None
+    # Number of dataset rows seen by the model, 0 if unknown.
+    trained_rows: int = 0
+    # Feature importances as served by the API, built from the model and not saved.
+    importance_payload: bytes = field(init=False, repr=False, default=b"")
+    # Validation scores and parameters of a tuned model, empty otherwise.
+    metrics: Dict[str, Any] = field(default_factory=dict)
+
+    def __post_init__(self):
+        if self.forest is None:
+            self.forest = FlatForest.from_sklearn(self.model)
+        self.importance_payload = encoding.dumps(
+            {"feature": self.features, "importance": self.model.feature_importances_}
+        )
+
+    @property
+    def importance_etag(self) -> str:
+        """ETag of the feature importances payload."""
+        return f'"{hashlib.sha256(self.importance_payload).hexdigest()[:32]}"'
+
+
+def _artifact_path(version: str, model_dir: str) -> str:
+    return os.path.join(model_dir, f"model-{version}.joblib")
+
+
+def _write_atomic(path: str, content: str) -> None:
+    with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+        file.write(content)
+    os.replace(f"{path}.tmp", path)
+
+
+def train_artifact(
+    progress: Optional[Callable[[str, float], None]] = None,
+    params: Optional[Dict[str, Any]] = None,
+) -> ModelArtifact:
+    """Trains a new model and wraps it in an artifact with a new version.
+
+    The progress callable receives the current stage and the fraction done. The
+    given forest params, usually the tuned ones, replace the defaults.
+    """
+    report = progress or (lambda stage, fraction: None)
+    report("loading data", 0.0)
+    train, target = ml_tools.load_data()
+    return _train_full(train, target, report, params)
+
+
+def _train_full(
+    train: pd.DataFrame,
+    target: pd.DataFrame,
+    report: Callable[[str, float], None],
+    params: Optional[Dict[str, Any]] = None,
+) -> ModelArtifact:
+    rows = len(train)
+    report("preparing data", 0.2)
+    train, preprocessor = ml_tools.prepare_train_data(train)
+    report("training", 0.3)
+    model = ml_tools.train_model(train, target, params)
+    report("exporting", 0.9)
+    return new_artifact(model, preprocessor, rows, _params_metrics(params))
+
+
+def _params_metrics(params: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    # Only the params are kept, the tuning scores do not hold for a new model.
+    return {"params": params} if params else None
+
+
+def tuned_params(model_dir: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Forest params of the latest model, None if it was not tuned or none exists."""
+    model_dir = model_dir or MODEL_DIR
+    try:
+        return load_artifact(model_dir=model_dir).metrics.get("params")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def new_artifact(
+    model: RandomForestClassifier,
+    preprocessor: ml_tools.Preprocessor,
+    trained_rows: int,
+    metrics: Optional[Dict[str, Any]] = None,
+) -> ModelArtifact:
+    """Wraps a model trained on the given number of rows with a new version."""
+    now = datetime.now(timezone.utc)
+    return ModelArtifact(
+        model=model,
+        preprocessor=preprocessor,
+        features=preprocessor.features,
+        version=now.strftime("%Y%m%d%H%M%S"),
+        created_at=now.isoformat(),
+        trained_rows=trained_rows,
+        metrics=metrics or {},
+    )
+
+
+def drift_score(seen: pd.DataFrame, new: pd.DataFrame) -> float:
+    """Largest shift of a feature mean in the new rows, counted in standard
+    deviations of the seen rows.
+    """
+    shift = (new.mean() - seen.mean()).abs() / seen.std().replace(0.0, float("nan"))
+    return float(shift.max(skipna=True))
+
+
+def update_artifact(  # pylint: disable=too-many-arguments, too-many-locals
+    artifact: ModelArtifact,
+    data: Optional[pd.DataFrame] = None,
+    *,
+    min_new_rows: int = 100,
+    new_trees: int = 2,
+    max_trees: Optional[int] = None,
+    sample_size: int = 20_000,
+    drift_threshold: float = 0.5,
+    progress: Optional[Callable[[str, float], None]] = None,
+) -> Optional[ModelArtifact]:
+    """Updates a model with the rows appended since it was trained.
+
+    New trees are added with ``warm_start``, fitted on the new rows and a sample of
+    the rows already seen, so the cost grows with the new data only. The model is
+    trained from scratch, with the same params, when it has more than max_trees
+    trees (ten times its initial size by default), when the rows it saw are not
+    known or when the new rows drifted too much. Returns None if there are fewer
+    than min_new_rows new rows. The given artifact is not modified.
+    """
+    report = progress or (lambda stage, fraction: None)
+    report("loading data", 0.0)
+    if data is None:
+        data = ml_tools.load_and_concatenate_data()
+    train, target = data.drop(columns="TARGET"), data[["TARGET"]]
+
+    seen = artifact.trained_rows
+    if len(train) - seen < min_new_rows:
+        logger.info("Only %s new rows, model kept", len(train) - seen)
+        return None
+    params = artifact.metrics.get("params")
+    if max_trees is None:
+        max_trees = 10 * {**ml_tools.FOREST_PARAMS, **(params or {})}["n_estimators"]
+    if not seen or artifact.model.n_estimators + new_trees > max_trees:
+        logger.info("Training a new model from all the rows")
+        return _train_full(train, target, report, params)
+
+    report("preparing data", 0.2)
+    sample = train.iloc[:seen].sample(min(sample_size, seen), random_state=len(train))
+    new = train.iloc[seen:]
+    drift = drift_score(sample[artifact.features], new[artifact.features])
+    if drift > drift_threshold:
+        logger.info("New rows drifted by %.2f, training a new model", drift)
+        return _train_full(train, target, report, params)
+
+    rows = sample.index.append(new.index)
+    features = pd.DataFrame(
+        artifact.preprocessor.transform(train.loc[rows]), columns=artifact.features
+    )
+    report("training", 0.3)
+    model = copy.deepcopy(artifact.model)
+    model.set_params(warm_start=True, n_estimators=model.n_estimators + new_trees)
+    model.fit(features, target.loc[rows, "TARGET"])
+    report("exporting", 0.9)
+    logger.info("Added %s trees trained on %s new rows", new_trees, len(new))
+    return new_artifact(
+        model, artifact.preprocessor, len(train), _params_metrics(params)
+    )
+
+
+def save_artifact(artifact: ModelArtifact, model_dir: Optional[str] = None) -> str:
+    """Writes the artifact and makes it the latest version.
+
+    Both files are written to a temporary name first and then renamed, so a worker
+    loading at the same time never reads a partial file.
+    """
+    model_dir = model_dir or MODEL_DIR
+    os.makedirs(model_dir, exist_ok=True)
+    path = _artifact_path(artifact.version, model_dir)
+
+    # Saved as a plain dict of the constructor arguments, so loading does not depend
+    # on how this module was run and the derived fields are rebuilt.
+    saved = {
+        item.name: getattr(artifact, item.name)
+        for item in fields(artifact)
+        if item.init
+    }
+    joblib.dump(saved, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+    set_latest(artifact.version, model_dir)
+
+    logger.info("Model version %s saved to %s", artifact.version, path)
+    return path
+
+
+def set_latest(version: str, model_dir: Optional[str] = None) -> None:
+    """Marks a saved version as the one to serve."""
+    model_dir = model_dir or MODEL_DIR
+    if not os.path.exists(_artifact_path(version, model_dir)):
+        raise FileNotFoundError(f"Model version {version} does not exist")
+    _write_atomic(os.path.join(model_dir, LATEST_FILE), version)
+
+
+def latest_version(model_dir: Optional[str] = None) -> str:
+    """Returns the version currently marked as latest."""
+    model_dir = model_dir or MODEL_DIR
+    with open(os.path.join(model_dir, LATEST_FILE), encoding="utf-8") as file:
+        return file.read().strip()
+
+
+def list_versions(model_dir: Optional[str] = None) -> List[str]:
+    """Lists the saved versions, oldest first."""
+    model_dir = model_dir or MODEL_DIR
+    if not os.path.isdir(model_dir):
+        return []
+    return sorted(
+        name[len("model-") : -len(".joblib")]
+        for name in os.listdir(model_dir)
+        if name.startswith("model-") and name.endswith(".joblib")
+    )
+
+
+def load_artifact(
+    version: Optional[str] = None, model_dir: Optional[str] = None
+) -> ModelArtifact:
+    """Loads a saved artifact, the latest one if no version is given.
+
+    Raises FileNotFoundError if no model was saved yet, ValueError if it was saved in
+    an older format.
+    """
+    model_dir = model_dir or MODEL_DIR
+    version = version or latest_version(model_dir)
+    try:
+        artifact = ModelArtifact(**joblib.load(_artifact_path(version, model_dir)))
+    except TypeError as error:
+        raise ValueError(f"Model version {version} has an older format") from error
+    logger.info("Model version %s loaded", artifact.version)
+    return artifact
+
+
+def rollback(version: Optional[str] = None, model_dir: Optional[str] = None) -> str:
+    """Serves the given version again, the one before the latest if not given.
+
+    Returns the version now marked as latest, FileNotFoundError if the given one
+    was not saved.
+    """
+    model_dir = model_dir or MODEL_DIR
+    versions = list_versions(model_dir)
+    if version is not None and version not in versions:
+        raise FileNotFoundError(f"Unknown model version {version}")
+    if version is None:
+        position = versions.index(latest_version(model_dir))
+        if position == 0:
+            raise ValueError("No previous model version")
+        version = versions[position - 1]
+    set_latest(version, model_dir)
+    logger.info("Rolled back to model version %s", version)
+    return version
+
+
+def _job_path(job_id: str, model_dir: str) -> str:
+    return os.path.join(model_dir, JOBS_DIR, f"{job_id}.json")
+
+
+def write_job_status(job_id: str, model_dir: Optional[str] = None, **status) -> None:
+    """Updates the status file of a training job with the given values."""
+    model_dir = model_dir or MODEL_DIR
+    os.makedirs(os.path.join(model_dir, JOBS_DIR), exist_ok=True)
+    try:
+        current = read_job_status(job_id, model_dir)
+    except FileNotFoundError:
+        current = {"job_id": job_id}
+    current.update(status)
+    _write_atomic(_job_path(job_id, model_dir), json.dumps(current))
+
+
+def read_job_status(job_id: str, model_dir: Optional[str] = None) -> Dict:
+    """Returns the status of a training job, FileNotFoundError if unknown."""
+    model_dir = model_dir or MODEL_DIR
+    with open(_job_path(job_id, model_dir), encoding="utf-8") as file:
+        return json.load(file)
+
+
+def run_training_job(
+    job_id: str, model_dir: Optional[str] = None, incremental: bool = False
+) -> None:
+    """Trains and saves a model while reporting to the job status file.
+
+    Meant to run in its own process, only one training runs at a time on a host.
+    An incremental job updates the latest model and may leave it unchanged.
+    """
+    model_dir = model_dir or MODEL_DIR
+
+    def report(stage: str, fraction: float):
+        write_job_status(job_id, model_dir, stage=stage, progress=fraction)
+
+    os.makedirs(model_dir, exist_ok=True)
+    with open(os.path.join(model_dir, TRAINING_LOCK), "a", encoding="utf-8") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            write_job_status(
+                job_id, model_dir, status="failed", error="Another training runs"
+            )
+            return
+
+        write_job_status(job_id, model_dir, status="running", pid=os.getpid())
+        try:
+            if incremental:
+                current = load_artifact(model_dir=model_dir)
+                artifact = update_artifact(current, progress=report)
+            else:
+                artifact = train_artifact(report, tuned_params(model_dir))
+            if artifact:
+                save_artifact(artifact, model_dir)
+            else:
+                artifact = current
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception("Training job %s failed", job_id)
+            write_job_status(job_id, model_dir, status="failed", error=str(error))
+            return
+
+    write_job_status(
+        job_id,
+        model_dir,
+        status="done",
+        stage="done",
+        progress=1.0,
+        version=artifact.version,
+        finished_at=datetime.now(timezone.utc).isoformat(),
+    )
+
+
+def main(args: Optional[List[str]] = None):
+    """Command line entry point to train and save a new model."""
+    parser = argparse.ArgumentParser(description="Train and save the risk model.")
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="add trees for the rows appended since the latest model",
+    )
+    parser.add_argument("--min-new-rows", type=int, default=100)
+    options = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    if options.incremental:
+        current = load_artifact(model_dir=options.model_dir)
+        artifact = update_artifact(current, min_new_rows=options.min_new_rows)
+        if artifact:
+            save_artifact(artifact, options.model_dir)
+    else:
+        artifact = train_artifact(params=tuned_params(options.model_dir))
+        save_artifact(artifact, options.model_dir)
+
+
+if __name__ == "__main__":
+    main()
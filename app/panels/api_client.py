@@ -0,0 +1,103 @@
+"""This module is the client of the prediction API used by the dashboard panels.
+
+All the calls share one keep-alive session per dashboard process, so the connection
+to the server is reused across reruns. Data that only changes with the model is
+cached by Streamlit and keyed on the served model version.
+"""
+from __future__ import annotations
+
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from app.settings import conf
+
+logger = logging.getLogger("front-app")
+
+# Seconds to connect and to wait for the answer.
+TIMEOUT = (3.05, 30)
+
+
+@st.cache_resource
+def get_session() -> requests.Session:
+    """Returns the pooled session, idempotent calls are retried on server errors."""
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=10, max_retries=retries))
+    session.mount("http://", HTTPAdapter(pool_maxsize=10, max_retries=retries))
+    session.headers["content-type"] = "application/json"
+    return session
+
+
+def _get(url: str) -> requests.Response:
+    return get_session().get(url, timeout=TIMEOUT)
+
+
+def _check(result: requests.Response, what: str) -> Any:
+    if result.status_code != 200:
+        raise ValueError(f"Cannot get {what} code {result.status_code}")
+    return json.loads(result.content.decode())
+
+
+@st.cache_data(ttl=30)
+def model_version() -> str:
+    """Version of the served model, checked again every 30 seconds."""
+    return _check(_get(conf.READY_ENDPOINT), "model version")["model_version"]
+
+
+def get_customer(customer_id: int) -> Optional[List[Dict[str, Any]]]:
+    """Gets the saved applications of a customer, None if unknown."""
+    logger.info("requesting previous client, client id: %s", customer_id)
+    result = _get(f"{conf.GET_CUSTOMER}/{customer_id}")
+    if result.status_code != 200:
+        return None
+    return json.loads(result.content.decode())
+
+
+def predict(customer: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Scores a customer, returns the score and prediction id or None on failure.
+
+    Not retried, every call saves a new prediction.
+    """
+    result = get_session().post(
+        conf.PREDICTION_ENDPOINT, json=customer, timeout=TIMEOUT
+    )
+    if result.status_code != 200:
+        logger.error("Prediction failed with code %s", result.status_code)
+        return None
+    return json.loads(result.content.decode())
+
+
+@st.cache_data(max_entries=2)
+def get_feature_importance(version: str) -> pd.DataFrame:
+    """Gets the feature importances of a model version."""
+    logger.info("Getting Feature Importance of model %s", version)
+    return pd.DataFrame(_check(_get(conf.GET_FI_ENDPOINT), "feature importance"))
+
+
+@st.cache_data(ttl=300, max_entries=2)
+def get_accepted_chart(version: str) -> Dict[str, Any]:
+    """Gets the accepted customers statistics ready to draw, they also change with
+    the saved decisions so they are fetched again after 5 minutes.
+    """
+    logger.info("Getting Accepted Stats for model %s", version)
+    return _check(_get(conf.GET_ACCEPTED_CHART_ENDPOINT), "accepted customers")
+
+
+# Explanations of the recent predictions, one per customer seen on the dashboard.
+@st.cache_data(max_entries=1000)
+def get_explanation(prediction_id: str) -> Dict[str, Any]:
+    """Gets the per feature contributions to the score of a prediction."""
+    logger.info("Getting explanation of prediction %s", prediction_id)
+    return _check(_get(f"{conf.EXPLAIN_ENDPOINT}/{prediction_id}"), "score explanation")
@@ -2,19 +2,19 @@
 from __future__ import annotations
 
 # pylint: disable=R0801
-import json
 import logging
 from dataclasses import asdict
 from logging.config import dictConfig
-from typing import TYPE_CHECKING, Any
+from typing import TYPE_CHECKING, Any, Dict, Tuple
 
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-import requests
 import streamlit as st
 
-from app.settings import conf, log_conf
+from app.panels import api_client
+from app.settings import log_conf
 
 if TYPE_CHECKING:
     from app.panels.customer_information import Customer
@@ -38,51 +38,31 @@ def pred_text(score: float) -> str:  # pylint: disable=inconsistent-return-state
         return f"{score} which is very high risk BE CAREFUL !"
 
 
-def display_importances(feature_importance_df: pd.DataFrame) -> None:
-    """Builds feature importance graph."""
-
-    feature_importance_df.sort_values(
-        by=["importance"],
-        ascending=False,
-        inplace=True,
-        ignore_index=True,
-        axis=0,
+# Figures of the current and the previous model or statistics, older ones are dropped.
+@st.cache_resource(max_entries=2)
+def importance_figure(version: str) -> go.Figure:
+    """Builds feature importance graph, once per model version."""
+    feature_importance_df = api_client.get_feature_importance(version).sort_values(
+        by=["importance"], ascending=False, ignore_index=True
     )
 
     figure = px.bar(feature_importance_df, x="feature", y="importance")
     figure.update_layout(title_text="Feature importance on model (from all clients)")
-    st.plotly_chart(figure)
-
-
-def plot_accepted_vs_current(customer: Customer, accepted: Any) -> None:
-    """Plots bar graphs of bolean and radar chart for the others."""
-
-    logger.info("plot funct got type: %s", type(accepted))
-
-    # ________ Radar Data Construction _______
-    radar_data = pd.read_json(accepted[0], orient="split")
-    customer_df = pd.DataFrame(asdict(customer), index=["customer"])
-    customer_df.drop(
-        ["FLAG_OWN_CAR", "FLAG_OWN_REALTY", "CNT_CHILDREN", "SK_ID_CURR", "TARGET"],
-        axis=1,
-        inplace=True,
-    )
-
-    radar_data = radar_data.append(customer_df)  # pylint: disable=no-member
-
-    # normalization
-    radar_data = (radar_data - radar_data.min()) / (radar_data.max() - radar_data.min())
-
-    categories = radar_data.columns
+    return figure
 
-    logger.info("building radar graph with DF:\n %s", radar_data)
 
-    fig = go.Figure()
+@st.cache_resource(max_entries=2)
+def accepted_figures(chart: Dict[str, Any]) -> Tuple[go.Figure, go.Figure, go.Figure]:
+    """Builds the graphs of the accepted customers, once per statistics.
 
-    fig.add_trace(
+    Returns the radar chart without the customer, the flags and the children bar
+    charts. The figures are shared by every session and must not be modified.
+    """
+    radar = go.Figure()
+    radar.add_trace(
         go.Scatterpolar(
-            r=radar_data.loc["max"].values,
-            theta=categories,
+            r=[1.0] * len(chart["features"]),
+            theta=chart["features"],
             fill="toself",
             fillcolor="grey",
             opacity=0.4,
@@ -90,10 +70,10 @@ def plot_accepted_vs_current(customer: Customer, accepted: Any) -> None:
             name="Accepted max",
         )
     )
-    fig.add_trace(
+    radar.add_trace(
         go.Scatterpolar(
-            r=radar_data.loc["mean"].values,
-            theta=categories,
+            r=chart["scaled_mean"],
+            theta=chart["features"],
             fill="toself",
             fillcolor="rgba(0, 0, 255, 0.4)",
             opacity=0.6,
@@ -101,107 +81,114 @@ def plot_accepted_vs_current(customer: Customer, accepted: Any) -> None:
             name="Accepted Mean",
         )
     )
-    fig.add_trace(
-        go.Scatterpolar(
-            r=radar_data.loc["customer"].values,
-            theta=categories,
-            fill="toself",
-            fillcolor="rgba(0, 255, 0, 0.4)",
-            opacity=0.6,
-            marker={"color": "Green"},
-            name="Client situation",
-        )
-    )
-
-    fig.update_layout(
+    radar.update_layout(
         polar={"radialaxis": {"visible": True, "range": [0, 1]}},
         showlegend=True,
         title_text="Customer data compared to the mean and max of all approuved "
         "applications",
     )
 
-    # Display radar chart
-    st.plotly_chart(fig)
+    counts = chart["counts"]
+    fig_mixed = go.Figure(
+        [
+            go.Bar(x=counts[name]["values"], y=counts[name]["counts"], name=name)
+            for name in ["FLAG_OWN_CAR", "FLAG_OWN_REALTY"]
+        ]
+    )
+    fig_mixed.update_layout(
+        barmode="stack",
+        title_text="Car and Realty tenants among customers with authorized credits",
+        xaxis={
+            "title": "Has item =1, does not has item = 0",
+            "tickmode": "linear",
+            "tick0": 0,
+            "dtick": 1,
+        },
+        yaxis={"title": "Number of accepted customers in database"},
+    )
 
-    # ____________________ Bar Chart Construction _____________________
+    children = counts["CNT_CHILDREN"]
+    fig_children = go.Figure(
+        go.Bar(x=children["values"][:-5], y=children["counts"][:-5])
+    )
+    fig_children.update_layout(
+        title_text="Number of children per accepted applicant in database",
+        xaxis={
+            "title": "Number of children",
+            "tickmode": "linear",
+            "tick0": 0,
+            "dtick": 1,
+        },
+        yaxis={"title": "Number of accepted customers in database"},
+    )
+    return radar, fig_mixed, fig_children
 
-    bar_data = accepted[1]
-    own_car, own_realty, cnt_children = [pd.read_json(data) for data in bar_data]
 
-    mixed_yes_no = own_car.append(own_realty, ignore_index=True)
+def plot_accepted_vs_current(customer: Customer, chart: Dict[str, Any]) -> None:
+    """Plots bar graphs of bolean and radar chart for the others."""
+    radar, fig_mixed, fig_children = accepted_figures(chart)
 
-    fig_mixed = px.bar(
-        mixed_yes_no,
-        x="index",
-        labels={
-            "index": "Has item =1, does not has item = 0",
-            "data": "Number of accepted customers in database",
-        },
-        y="data",
-        color="name",
-        title="Car and Realty tenants among customers with authorized credits",
-    )
-    fig_mixed.update_layout(xaxis={"tickmode": "linear", "tick0": 0, "dtick": 1})
-
-    fig_children = px.bar(
-        cnt_children.iloc[:-5, :],
-        x="index",
-        labels={
-            "index": "Number of children",
-            "data": "Number of accepted customers in database",
-        },
-        y="data",
-        title="Number of children per accepted applicant in database",
+    # Customer normalized with the bounds of the accepted ones, unknown values at 0.
+    data = asdict(customer)
+    values = np.array([data[feature] for feature in chart["features"]], dtype=float)
+    lower, upper = np.array(chart["min"]), np.array(chart["max"])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scaled = np.clip(np.nan_to_num((values - lower) / (upper - lower)), 0.0, 1.0)
+
+    # Copied, the cached figure is shared between the reruns and the sessions.
+    fig = go.Figure(radar)
+    fig.add_trace(
+        go.Scatterpolar(
+            r=scaled,
+            theta=chart["features"],
+            fill="toself",
+            fillcolor="rgba(0, 255, 0, 0.4)",
+            opacity=0.6,
+            marker={"color": "Green"},
+            name="Client situation",
+        )
     )
-    fig_children.update_layout(xaxis={"tickmode": "linear", "tick0": 0, "dtick": 1})
 
-    # Show the graphs
+    st.plotly_chart(fig)
     st.plotly_chart(fig_mixed)
     st.plotly_chart(fig_children)
 
 
 def get_fi():
     """Gets Feature importance and builds the graph to display"""
-    logger.info("Getting Feature Importance")
+    st.plotly_chart(importance_figure(api_client.model_version()))
+
 
-    result = requests.request(
-        method="GET",
-        url=conf.GET_FI_ENDPOINT,
-        headers={"content-type": "application/json"},
-        timeout=360,
+def display_contributions(explanation: dict) -> None:
+    """Builds the graph of what moved the customer score away from the average."""
+    contributions = pd.DataFrame(
+        explanation["contributions"].items(), columns=["feature", "contribution"]
+    ).sort_values(by="contribution", key=abs, ascending=False)
+
+    figure = px.bar(
+        contributions,
+        x="feature",
+        y="contribution",
+        color=contributions.contribution > 0,
+        color_discrete_map={True: "red", False: "green"},
+    )
+    figure.update_layout(
+        title_text="Contributions to the customer score "
+        f"(average score {explanation['bias']:.3f})",
+        showlegend=False,
     )
+    st.plotly_chart(figure)
 
-    if result.status_code == 200:
-        feat_imp = json.loads(result.content.decode())
-        logger.info("Got FI as: %s", feat_imp)
-        feat_imp = pd.read_json(feat_imp, orient="split")
-        display_importances(feat_imp)
-    else:
-        raise ValueError(
-            f"Cannot Display Feature Importance Graph code {result.status_code}"
-        )
 
+def get_explanation(prediction_id: str):
+    """Gets the contributions of every feature to the customer score."""
+    display_contributions(api_client.get_explanation(prediction_id))
 
-def get_accepted_stats(customer: Customer):
-    """Gets a describe data frame of the previously accepted customers."""
-    logger.info("Getting Accepted Stats")
-
-    result = requests.request(
-        method="GET",
-        url=conf.GET_ACCEPTED_DESC_ENDPOINT,
-        headers={"content-type": "application/json"},
-        timeout=360,
-    )
 
-    if result.status_code == 200:
-        accepted_stats = json.loads(result.content.decode())
-        logger.info("Got Accepted stats as: %s", accepted_stats)
-        plot_accepted_vs_current(customer, accepted_stats)
-    else:
-        raise ValueError(
-            f"Cannot display graph: accepted customers vs current code"
-            f" {result.status_code}"
-        )
+def get_accepted_stats(customer: Customer):
+    """Gets the statistics of the previously accepted customers."""
+    chart = api_client.get_accepted_chart(api_client.model_version())
+    plot_accepted_vs_current(customer, chart)
 
 
 # Custumer analysis page is built up on this function.
@@ -215,6 +202,10 @@ def customer_analysis(score: float, customer: Customer):
     # Display feature importances of the model used to make the prediction.
     get_fi()
 
+    # Display what made this customer score differ from the average one.
+    if "prediction_id" in st.session_state:
+        get_explanation(st.session_state["prediction_id"])
+
     # Display position of client relative to the average client wich was accepted.
 
     get_accepted_stats(customer)
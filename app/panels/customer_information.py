@@ -5,16 +5,15 @@ to obtain a risk prediction.
 from __future__ import annotations
 
 import datetime
-import json
 import logging
 from dataclasses import asdict, dataclass
 from logging.config import dictConfig
 from typing import Optional, Union
 
-import requests
 import streamlit as st
 
-from app.settings import conf, log_conf
+from app.panels import api_client
+from app.settings import log_conf
 
 dictConfig(log_conf.dict())
 logger = logging.getLogger("ml-app")
@@ -122,25 +121,17 @@ def dashboard() -> tuple[Optional[float], Customer]:
     temp_customer: Optional[Customer] = None
 
     if st.button("Get Customer"):
-        logger.info("requesting previous client, client id: %s", customer_id)
-        result = requests.request(
-            method="GET",
-            url="".join([conf.GET_CUSTOMER, "/", str(customer_id)]),
-            headers={"content-type": "application/json"},
-            timeout=360,
-        )
-        logger.info("got customer raw info as: %s", json.loads(result.content.decode()))
-
-        if result.status_code == 200:
-            customer = json.loads(result.content.decode())[-1]
-            temp_customer = Customer(**customer)
+        applications = api_client.get_customer(customer_id)
+
+        if applications:
+            temp_customer = Customer(**applications[-1])
             logger.info("Got customer as: %s", asdict(temp_customer))
             st.success(
                 f"Customer previous application status is: "
                 f"{'accepted' if temp_customer.TARGET == 0 else 'rejected'}"
             )
         else:
-            logger.error("The request failed: %s")
+            logger.error("Customer %s not found", customer_id)
             st.error(f"Customer {customer_id} not found")
 
     has_car = temp_customer.FLAG_OWN_CAR if temp_customer else 0
@@ -191,16 +182,11 @@ def dashboard() -> tuple[Optional[float], Customer]:
     if st.button("Calculate"):
         data = asdict(customer)
         logger.info("Running_dashboard: %s", data)
-        result = requests.request(
-            method="POST",
-            url=conf.PREDICTION_ENDPOINT,
-            headers={"content-type": "application/json"},
-            json=data,
-            timeout=360,
-        )
-
-        if result.status_code == 200:
-            pred = result.content.decode()
+        prediction = api_client.predict(data)
+
+        if prediction:
+            pred = prediction["score"]
+            st.session_state["prediction_id"] = prediction["prediction_id"]
             st.success(f"Score = {pred}.\nYou can go to Customer Analysis Tab")
 
         return float(pred) if pred else pred, customer
@@ -2,22 +2,59 @@
 MlFlow server model prediction scheme.
 """
 # pylint: disable=no-name-in-module, too-few-public-methods, R0801
+import asyncio
+import functools
 import logging
+import multiprocessing
+import os
+import random
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from logging.config import dictConfig
-from typing import Optional
+from typing import Any, Dict, Iterator, List, Optional
 
+import numpy as np
 import pandas as pd
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from sklearn.ensemble import RandomForestClassifier
-
-from app import ml_tools
-from app.settings import log_conf
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, parse_obj_as
+
+from app import (
+    batching,
+    encoding,
+    executor,
+    metrics,
+    ml_tools,
+    model_store,
+    sessions,
+    storage,
+)
+from app.settings import log_conf, server_conf
 
 dictConfig(log_conf.dict())
 logger = logging.getLogger("ml-app")
 
-app = FastAPI(debug=True, title="Risk assessment API")
+# Responses returned as ORJSONResponse directly also skip jsonable_encoder.
+app = FastAPI(
+    debug=True, title="Risk assessment API", default_response_class=ORJSONResponse
+)
+
+METRICS = metrics.Registry()
+app.add_middleware(
+    metrics.RouteMetricsMiddleware, registry=METRICS, routes=app.router.routes
+)
+
+
+def log_payload(message: str, *args) -> None:
+    """Logs request data in debug, otherwise only for a sample of the requests as
+    formatting it costs more than the prediction.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message, *args)
+    elif random.random() < server_conf.PAYLOAD_LOG_RATE:
+        logger.info(message, *args)
 
 
 class Customer(BaseModel):
@@ -32,7 +69,8 @@ class Customer(BaseModel):
     AMT_INCOME_TOTAL: float
     AMT_CREDIT: float
     AMT_ANNUITY: float
-    EXT_SOURCE_1: float
+    # Unknown for half the customers, filled by the model preprocessor.
+    EXT_SOURCE_1: Optional[float] = None
     DAYS_BIRTH: float
     ANNUITY_INCOME_PERC: float
     DAYS_EMPLOYED_PERC: float
@@ -45,97 +83,621 @@ class Customer(BaseModel):
         return pd.DataFrame(self.dict(), index=[0])
 
 
-MODEL: Optional[RandomForestClassifier] = None
-CUSTOMER: Optional[Customer] = None
+# Concurrent calls allowed per operation sent to the worker threads.
+EXECUTOR = executor.Executor(
+    limits={
+        "predict": os.cpu_count() or 1,
+        "batch_predict": 1,
+        "explain": os.cpu_count() or 1,
+        "load_model": 1,
+        "load_data": 1,
+        # SQLite serializes the writes, more threads would only wait on its lock.
+        "sessions": 2,
+    },
+    # Slow calls on threads of their own, the predictions never wait for them.
+    background=["batch_predict", "load_model", "load_data"],
+)
+
+# Served model, replaced as a whole so a request keeps the one it started with.
+ARTIFACT: Optional[model_store.ModelArtifact] = None
+SESSIONS: Optional[sessions.PredictionSessions] = None
+STORE: Optional[ml_tools.CustomerStore] = None
+STATS: Optional[ml_tools.AcceptedStats] = None
+WRITER: Optional[storage.DecisionWriter] = None
+BATCHER: Optional[batching.MicroBatcher] = None
+TRAINER: Optional[ProcessPoolExecutor] = None
+MODEL_WATCHER: Optional[asyncio.Task] = None
+DATA_WATCHER: Optional[asyncio.Task] = None
+METRICS_EXPORTER: Optional[asyncio.Task] = None
+
+
+def serve_artifact(artifact: model_store.ModelArtifact) -> None:
+    """Makes the artifact the served one and reports its version."""
+    global ARTIFACT
+    description = "Served model version, 1 for the current one."
+    if ARTIFACT:
+        METRICS.gauge("risk_model_info", description, version=ARTIFACT.version).set(0)
+    ARTIFACT = artifact
+    METRICS.gauge("risk_model_info", description, version=artifact.version).set(1)
+
+
+def preload():
+    """Loads the model and the customers before the gunicorn workers are forked, the
+    workers then share the memory pages of this read only data.
+    """
+    load_model()
+    load_customer_store()
+
+
+@app.on_event("startup")
+def load_model():
+    """Loads the persisted model, a model is trained and saved if none exists yet.
+
+    A model preloaded by the gunicorn master is kept if it is still the latest.
+    """
+    if ARTIFACT and ARTIFACT.version == model_store.latest_version():
+        return
+    with METRICS.timer("load_model"):
+        try:
+            artifact = model_store.load_artifact()
+        except (FileNotFoundError, ValueError) as error:
+            logger.warning("No model to load (%s), training a new one", error)
+            artifact = model_store.train_artifact()
+            model_store.save_artifact(artifact)
+    serve_artifact(artifact)
+
+
+async def swap_model(version: str):
+    """Loads a saved version in a worker thread then serves it."""
+    with METRICS.timer("load_model"):
+        artifact = await EXECUTOR.run("load_model", model_store.load_artifact, version)
+    serve_artifact(artifact)
+    logger.info("Now serving model version %s", version)
+
+
+async def watch_latest_model():
+    """Serves the latest version as soon as a training or rollback changes it, so
+    every worker follows whichever worker received the request.
+    """
+    while True:
+        await asyncio.sleep(server_conf.MODEL_POLL_SECONDS)
+        try:
+            version = model_store.latest_version()
+            if version != ARTIFACT.version:
+                await swap_model(version)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Cannot reload model, ERROR %s: ", error)
+
+
+@app.on_event("startup")
+async def start_model_watcher():
+    """Starts polling the latest model version."""
+    global MODEL_WATCHER
+    MODEL_WATCHER = asyncio.create_task(watch_latest_model())
+
+
+@app.on_event("shutdown")
+def stop_model_training():
+    """Stops watching the model and waits for a running training."""
+    if MODEL_WATCHER:
+        MODEL_WATCHER.cancel()
+    if TRAINER:
+        TRAINER.shutdown(wait=True)
+
+
+@app.on_event("startup")
+def start_micro_batching():
+    """Creates the batcher of single predictions if enabled in the settings."""
+    global BATCHER
+    if server_conf.MICRO_BATCHING:
+        BATCHER = batching.MicroBatcher(
+            predict_matrix,
+            functools.partial(EXECUTOR.run, "predict"),
+            max_wait=server_conf.BATCH_MAX_WAIT_MS / 1000,
+            max_batch=server_conf.BATCH_MAX_SIZE,
+        )
 
 
-def verify_model():
-    """Verifies model exists and is trained."""
-    global MODEL
-    if not MODEL:
-        MODEL = ml_tools.train_and_return()
+@app.on_event("startup")
+def start_decision_writer():
+    """Starts the background writer of the advisor decisions."""
+    global WRITER
+    WRITER = storage.DecisionWriter()
+    WRITER.start()
 
 
-def predict_risk(data: pd.DataFrame):
-    """Makes a prediction from the imputed data."""
+@app.on_event("shutdown")
+def stop_decision_writer():
+    """Writes the pending decisions before the worker exits."""
+    WRITER.stop()
 
-    verify_model()
-    data = ml_tools.prepare_predict_data(data)
 
-    try:
-        logger.info("Running predict function with data: %s", data)
-        prediction = MODEL.predict_proba(data)
+@app.on_event("startup")
+def open_prediction_sessions():
+    """Opens the predictions store shared by the workers."""
+    global SESSIONS
+    SESSIONS = sessions.PredictionSessions(sessions.SqliteBackend())
+
 
-        return prediction[0][1]
+@app.on_event("shutdown")
+def stop_executor():
+    """Lets the running operations finish before the worker exits."""
+    EXECUTOR.shutdown()
+
+
+@app.on_event("startup")
+def load_customer_store():
+    """Loads the customers dataset once so lookups and statistics are served from
+    memory.
+    """
+    global STORE, STATS
+    if STORE:
+        # Preloaded by the gunicorn master, only the rows saved since are added.
+        refresh_customer_store()
+        return
+    logger.info("Loading customer store")
+    with METRICS.timer("load_data"):
+        STORE = ml_tools.CustomerStore.from_disk()
+        STATS = ml_tools.AcceptedStats(STORE.to_pandas())
+    logger.info("Customer store ready with %s rows", len(STORE))
+
+
+def refresh_customer_store():
+    """Adds to the store and the statistics the customers saved since the files
+    were read, by the other workers in particular. Only the end of the decision log
+    is read, the whole store is loaded again if it was compacted too often since.
+    """
+    global STORE, STATS
+    with METRICS.timer("load_data"):
+        tail = storage.read_decisions_since(STORE.log_position)
+    if tail is None:
+        logger.warning("Decisions compacted since the last refresh, reloading")
+        with METRICS.timer("load_data"):
+            store = ml_tools.CustomerStore.from_disk()
+            STORE, STATS = store, ml_tools.AcceptedStats(store.to_pandas())
+        return
+    added = STORE.sync(*tail)
+    with METRICS.timer("stats_update"):
+        for customer in added:
+            STATS.add(customer)
+    if added:
+        logger.info("Added %s customers saved by other workers", len(added))
+
+
+async def watch_customer_data():
+    """Follows the customers saved by the other workers, so every worker answers
+    /get_customer and the accepted statistics the same way.
+    """
+    while True:
+        await asyncio.sleep(server_conf.DATA_POLL_SECONDS)
+        try:
+            await EXECUTOR.run("load_data", refresh_customer_store)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Cannot refresh customers, ERROR %s: ", error)
+
+
+@app.on_event("startup")
+async def start_data_watcher():
+    """Starts polling the customer data files."""
+    global DATA_WATCHER
+    DATA_WATCHER = asyncio.create_task(watch_customer_data())
+
+
+@app.on_event("shutdown")
+def stop_data_watcher():
+    """Stops polling the customer data files."""
+    if DATA_WATCHER:
+        DATA_WATCHER.cancel()
+
+
+@app.on_event("startup")
+def register_metrics():
+    """Exports the counters kept by the other components."""
+    METRICS.counter(
+        "process_cpu_seconds_total",
+        "CPU time used by the worker process.",
+        time.process_time,
+    )
+    for name, stats in EXECUTOR.stats.items():
+        METRICS.gauge(
+            "risk_executor_queued",
+            "Operations waiting for a slot.",
+            lambda stats=stats: stats.queued,
+            operation=name,
+        )
+        METRICS.gauge(
+            "risk_executor_running",
+            "Operations running in the pool.",
+            lambda stats=stats: stats.running,
+            operation=name,
+        )
+    for result, attribute in [("hit", "hits"), ("miss", "misses")]:
+        METRICS.counter(
+            "risk_cache_requests_total",
+            "Lookups of the caches by result.",
+            lambda attribute=attribute: getattr(SESSIONS, attribute),
+            cache="sessions",
+            result=result,
+        )
+    for cache in [
+        "sessions",
+        "accepted_description",
+        "accepted_chart",
+        "feature_importance",
+    ]:
+        METRICS.gauge(
+            "risk_cache_hit_ratio",
+            "Share of the cache lookups that were hits.",
+            functools.partial(cache_hit_ratio, cache),
+            cache=cache,
+        )
+    if BATCHER:
+        METRICS.register("risk_batch_size", "Rows per micro batch.", BATCHER.batch_size)
+        METRICS.register(
+            "risk_batch_wait_seconds",
+            "Time rows wait for their micro batch.",
+            BATCHER.wait_time,
+        )
+
+
+def cache_hit_ratio(cache: str) -> float:
+    """Hits over lookups of a cache, 0 before the first lookup."""
+    hits, misses = (
+        METRICS.counter(
+            "risk_cache_requests_total", "", cache=cache, result=result
+        ).value
+        for result in ["hit", "miss"]
+    )
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+def verify_model() -> model_store.ModelArtifact:
+    """Verifies model was loaded at startup and returns it."""
+    artifact = ARTIFACT
+    if not artifact:
+        raise HTTPException(503, "Model is not loaded yet")
+    return artifact
+
+
+def predict_risk(
+    customer: Customer, artifact: Optional[model_store.ModelArtifact] = None
+) -> float:
+    """Makes a prediction for one customer with the flattened forest, of the served
+    model if no artifact is given.
+    """
+
+    artifact = artifact or verify_model()
+    try:
+        with METRICS.timer("preprocess"):
+            row = artifact.preprocessor.transform_customers([customer])
+        with METRICS.timer("predict"):
+            return float(artifact.forest.predict_proba(row)[0, 1])
 
     except Exception as exception:
         raise HTTPException(418, f"Failed to predict {exception}") from exception
 
 
+def predict_matrix(matrix: np.ndarray) -> np.ndarray:
+    """Scores feature rows in the model features order."""
+    with METRICS.timer("predict"):
+        return verify_model().forest.predict_proba(matrix)[:, 1]
+
+
 @app.post("/make_prediction")
 async def calculate_risk(form_request: Customer):
-    """Prepares data from user and gets a prediction."""
-    global CUSTOMER
-    CUSTOMER = form_request
-    logger.info("Running model with data: %s", CUSTOMER.dict())
-    return predict_risk(CUSTOMER.to_pandas())
+    """Prepares data from user and gets a prediction.
+
+    The returned prediction id is used to save the advisor decision.
+    """
+    log_payload("Running model with data: %s", form_request)
+    artifact = verify_model()
+    if BATCHER:
+        with METRICS.timer("preprocess"):
+            row = artifact.preprocessor.transform_customers([form_request])[0]
+        score = await BATCHER.submit(row)
+        if ARTIFACT is not artifact:
+            # The batch may have been scored by the model served meanwhile.
+            score = await EXECUTOR.run("predict", predict_risk, form_request, artifact)
+    else:
+        score = await EXECUTOR.run("predict", predict_risk, form_request, artifact)
+    prediction = sessions.Prediction(
+        form_request.dict(), score, model_version=artifact.version
+    )
+    with METRICS.timer("session_save"):
+        prediction_id = await EXECUTOR.run("sessions", SESSIONS.save, prediction)
+    return ORJSONResponse({"prediction_id": prediction_id, "score": score})
+
+
+def score_records(
+    artifact: model_store.ModelArtifact, records: List[Any], start: int
+) -> np.ndarray:
+    """Validates and scores one chunk of a batch, start being the position of its
+    first customer in the batch.
+    """
+    try:
+        with METRICS.timer("parse"):
+            customers = parse_obj_as(List[Customer], records)
+    except ValueError as error:
+        raise HTTPException(
+            422, f"Invalid customers from position {start}: {error}"
+        ) from error
+    with METRICS.timer("preprocess"):
+        matrix = artifact.preprocessor.transform_customers(customers)
+    with METRICS.timer("predict"):
+        return ml_tools.predict_batch(
+            artifact.model, matrix, artifact.features, len(records)
+        )
+
+
+def score_json_batch(
+    artifact: model_store.ModelArtifact, body: bytes, chunk_size: int
+) -> np.ndarray:
+    """Scores a JSON list of customers chunk by chunk, the customers and parsed
+    records of a chunk are released once it is scored.
+    """
+    try:
+        with METRICS.timer("parse"):
+            records = encoding.loads(body)
+    except ValueError as error:
+        raise HTTPException(422, f"Invalid JSON: {error}") from error
+    if not isinstance(records, list):
+        raise HTTPException(422, "Invalid customers: a list is expected")
+
+    scores = np.empty(len(records), dtype=np.float64)
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start : start + chunk_size]
+        scores[start : start + len(chunk)] = score_records(artifact, chunk, start)
+        records[start : start + len(chunk)] = [None] * len(chunk)
+    return scores
+
+
+def score_ndjson_chunk(
+    artifact: model_store.ModelArtifact, lines: List[bytes], start: int
+) -> np.ndarray:
+    """Parses and scores one chunk of customers sent one per line."""
+    try:
+        with METRICS.timer("parse"):
+            records = [encoding.loads(line) for line in lines]
+    except ValueError as error:
+        raise HTTPException(
+            422, f"Invalid JSON line from position {start}: {error}"
+        ) from error
+    return score_records(artifact, records, start)
+
+
+async def score_ndjson_batch(
+    request: Request, artifact: model_store.ModelArtifact, chunk_size: int
+) -> np.ndarray:
+    """Scores the customers sent one per line as the body is received, chunk_size
+    lines at a time, so the whole body is never held in memory.
+    """
+    scores: List[np.ndarray] = []
+    lines: List[bytes] = []
+    rest = b""
+    done = 0
+
+    async def score_lines():
+        nonlocal lines, done
+        scores.append(
+            await EXECUTOR.run(
+                "batch_predict", score_ndjson_chunk, artifact, lines, done
+            )
+        )
+        done += len(lines)
+        lines = []
+
+    async for data in request.stream():
+        *complete, rest = (rest + data).split(b"\n")
+        for line in complete:
+            if line.strip():
+                lines.append(line)
+            if len(lines) == chunk_size:
+                await score_lines()
+    if rest.strip():
+        lines.append(rest)
+    if lines:
+        await score_lines()
+    return np.concatenate(scores) if scores else np.empty(0)
+
+
+def serialize_scores(scores: np.ndarray, arrow: bool) -> bytes:
+    """Returns scores as a JSON list, or as an Arrow stream with a score column."""
+    with METRICS.timer("serialize"):
+        if arrow:
+            return encoding.to_arrow(pd.DataFrame({"score": scores}))
+        return encoding.dumps(scores)
+
+
+def accept_arrow(request: Request) -> bool:
+    """Whether the client asked for Arrow, 406 if it cannot be produced."""
+    if not encoding.wants_arrow(request.headers.get("accept", "")):
+        return False
+    if not encoding.arrow_available():
+        raise HTTPException(406, "Arrow output needs the pyarrow package")
+    return True
+
+
+@app.post("/make_predictions")
+async def calculate_risks(
+    request: Request, chunk_size: int = Query(10_000, gt=0)
+) -> List[float]:
+    """Scores a batch of customers in one call, scores keep the input order.
+
+    The body is a JSON list of customers, or one customer per line when sent with
+    the application/x-ndjson content type. Scores are sent as an Arrow stream when
+    the Accept header asks for it.
+    """
+    ndjson = request.headers.get("content-type", "").startswith("application/x-ndjson")
+    arrow = accept_arrow(request)
+    # Every chunk is scored by the same model, even if another one is served meanwhile.
+    artifact = verify_model()
+    if ndjson:
+        scores = await score_ndjson_batch(request, artifact, chunk_size)
+    else:
+        scores = await EXECUTOR.run(
+            "batch_predict",
+            score_json_batch,
+            artifact,
+            await request.body(),
+            chunk_size,
+        )
+    logger.info("Scored a batch of %s customers", len(scores))
+    payload = await EXECUTOR.run("batch_predict", serialize_scores, scores, arrow)
+    media_type = encoding.ARROW_STREAM if arrow else "application/json"
+    return Response(payload, media_type=media_type)
+
+
+def explain_customers(
+    customers: List[Customer], artifact: Optional[model_store.ModelArtifact] = None
+) -> List[Dict[str, Any]]:
+    """Splits the scores of the customers into per feature contributions, with the
+    served model if no artifact is given.
+
+    The contributions of a customer added to its bias give its score.
+    """
+    artifact = artifact or verify_model()
+    with METRICS.timer("preprocess"):
+        matrix = artifact.preprocessor.transform_customers(customers)
+    with METRICS.timer("explain"):
+        bias, contributions = artifact.forest.explain(matrix)
+    return [
+        {
+            "model_version": artifact.version,
+            "bias": bias,
+            "contributions": dict(zip(artifact.features, row.tolist())),
+        }
+        for row in contributions
+    ]
+
+
+# Models no longer served, kept for the explanations of the predictions they made.
+load_previous_artifact = functools.lru_cache(maxsize=2)(model_store.load_artifact)
+
+
+async def scoring_artifact(version: Optional[str]) -> model_store.ModelArtifact:
+    """Returns the model of the given version, the served one if it is that version
+    or if no version is given. 410 if the version was deleted or can not be loaded.
+    """
+    artifact = verify_model()
+    if version is None or version == artifact.version:
+        return artifact
+    try:
+        with METRICS.timer("load_model"):
+            return await EXECUTOR.run("load_model", load_previous_artifact, version)
+    except FileNotFoundError as error:
+        raise HTTPException(410, f"Model version {version} was deleted") from error
+    except ValueError as error:
+        raise HTTPException(410, str(error)) from error
+
+
+@app.get("/explain/{prediction_id}")
+async def explain_prediction(prediction_id: str):
+    """Explains the score of a prediction with the model that gave it, the
+    explanation is kept with the prediction so it is computed only once.
+
+    The score of a prediction saved without its model version is the one of the
+    served model, given by the explanation.
+    """
+    prediction = await EXECUTOR.run("sessions", SESSIONS.get, prediction_id)
+    if not prediction:
+        raise HTTPException(404, "Unknown prediction")
+
+    if prediction.explanation is None:
+        artifact = await scoring_artifact(prediction.model_version)
+        customer = Customer(**prediction.customer)
+        prediction.explanation = (
+            await EXECUTOR.run("explain", explain_customers, [customer], artifact)
+        )[0]
+        await EXECUTOR.run("sessions", SESSIONS.update, prediction_id, prediction)
+    score = prediction.score
+    if prediction.model_version is None:
+        explanation = prediction.explanation
+        score = explanation["bias"] + sum(explanation["contributions"].values())
+    return ORJSONResponse({"score": score, **prediction.explanation})
+
+
+@app.post("/explain")
+async def explain_batch(customers: List[Customer]) -> List[Dict[str, Any]]:
+    """Explains the scores of a batch of customers, in the input order."""
+    return ORJSONResponse(await EXECUTOR.run("explain", explain_customers, customers))
 
 
 @app.post("/decision/{target}")
-async def save_customer(target: bool):
-    """Receives advisor decision and saves customer"""
+async def save_customer(target: bool, prediction_id: str):
+    """Receives advisor decision and saves customer of the given prediction."""
 
-    if not CUSTOMER:
-        raise HTTPException(400, "Cannot save if no prediction was made")
+    prediction = await EXECUTOR.run("sessions", SESSIONS.get, prediction_id)
+    if not prediction:
+        raise HTTPException(404, "Cannot save if no prediction was made")
 
-    CUSTOMER.TARGET = target
+    customer = Customer(**{**prediction.customer, "TARGET": target})
     try:
-        ml_tools.append_new_customer(CUSTOMER)
+        with METRICS.timer("append"):
+            ml_tools.append_new_customer(customer, STORE, WRITER)
     except ValueError as error:
         raise HTTPException(400, "Customer ID error") from error
-    logger.info("Customer saved , olk =;with data: %s", CUSTOMER.dict())
+    with METRICS.timer("stats_update"):
+        STATS.add(customer.dict())
+    log_payload("Customer saved with data: %s", customer)
     return {"Status": "Customer was saved with current values"}
 
 
+def count_cache_lookup(cache: str, hit: bool) -> None:
+    """Counts a client cache validation, a hit is answered with a 304."""
+    METRICS.counter(
+        "risk_cache_requests_total",
+        "Lookups of the caches by result.",
+        cache=cache,
+        result="hit" if hit else "miss",
+    ).inc()
+
+
 @app.get("/get_feature_importance")
-async def get_feature_importance():
-    """Calculates and returns feature importance dataframe as json dict.
-
-    http response data should be reconverted to data frame with the function:
-    pd.read_json(data, orient='split')
-    """
-
-    features = [
-        "FLAG_OWN_CAR",
-        "FLAG_OWN_REALTY",
-        "CNT_CHILDREN",
-        "AMT_INCOME_TOTAL",
-        "AMT_CREDIT",
-        "AMT_ANNUITY",
-        "EXT_SOURCE_1",
-        "DAYS_BIRTH",
-        "ANNUITY_INCOME_PERC",
-        "DAYS_EMPLOYED_PERC",
-        "INCOME_CREDIT_PERC",
-        "PAYMENT_RATE",
-    ]
-    verify_model()
-    logger.info("Getting feature importances")
-    feature_importance = pd.DataFrame(
-        {"feature": features, "importance": MODEL.feature_importances_}
-    )
+async def get_feature_importance(request: Request):
+    """Returns the feature importances as a dict of the feature and importance
+    lists, a data frame is rebuilt with pd.DataFrame(data).
 
-    return feature_importance.to_json(orient="split")
+    The payload is computed once per model version, a request sending the current
+    ETag in If-None-Match gets a 304 without body.
+    """
+    artifact = verify_model()
+    headers = {"ETag": artifact.importance_etag, "Cache-Control": "no-cache"}
+    cached = request.headers.get("if-none-match") == artifact.importance_etag
+    count_cache_lookup("feature_importance", cached)
+    if cached:
+        return Response(status_code=304, headers=headers)
+    return Response(
+        artifact.importance_payload, media_type="application/json", headers=headers
+    )
 
 
 @app.get("/get_accepted_description")
-async def get_accepted_description():
-    """Gets statistic data for customers with granted credits"""
-    if not CUSTOMER:
-        raise HTTPException(
-            400, "Customer data is not available yet, make a prediction first."
-        )
-    return ml_tools.get_general_data_description()
+async def get_accepted_description(request: Request):
+    """Gets statistic data for customers with granted credits, see
+    AcceptedStats.to_list.
+
+    The payload is cached, a request sending the current ETag in If-None-Match gets
+    a 304 without body.
+    """
+    headers = {"ETag": STATS.etag, "Cache-Control": "no-cache"}
+    cached = request.headers.get("if-none-match") == STATS.etag
+    count_cache_lookup("accepted_description", cached)
+    if cached:
+        return Response(status_code=304, headers=headers)
+    return Response(STATS.payload, media_type="application/json", headers=headers)
+
+
+@app.get("/get_accepted_chart")
+async def get_accepted_chart(request: Request):
+    """Gets the statistics of the customers with granted credits ready to be drawn,
+    see AcceptedStats.to_chart. Cached with an ETag like the description.
+    """
+    headers = {"ETag": STATS.chart_etag, "Cache-Control": "no-cache"}
+    cached = request.headers.get("if-none-match") == STATS.chart_etag
+    count_cache_lookup("accepted_chart", cached)
+    if cached:
+        return Response(status_code=304, headers=headers)
+    return Response(STATS.chart_payload, media_type="application/json", headers=headers)
 
 
 @app.get("/get_customer/{customer_id}")
@@ -143,9 +705,250 @@ async def get_customer(customer_id: int):
     """Gets customer information if customer id is known."""
     logger.info("Getting customer data for customer: %s", customer_id)
     try:
-        data = ml_tools.get_customer(customer_id)
+        data = ml_tools.get_customer(customer_id, STORE)
     except ValueError as error:
         raise HTTPException(400, "Client not found") from error
 
-    logger.info("Replying with customer data: %s", data)
-    return data
+    log_payload("Replying with customer data: %s", data)
+    return ORJSONResponse(data)
+
+
+def score_chunks(
+    artifact: model_store.ModelArtifact,
+    chunk_size: int,
+    filters: Dict[str, Optional[float]],
+) -> Iterator[pd.DataFrame]:
+    """Scores the stored customers chunk by chunk, so memory use only depends on the
+    chunk size. Filters are passed to the store.
+    """
+    for chunk in STORE.iter_chunks(chunk_size, **filters):
+        with METRICS.timer("preprocess"):
+            matrix = artifact.preprocessor.transform(chunk)
+        with METRICS.timer("predict"):
+            scores = ml_tools.predict_batch(
+                artifact.model, matrix, artifact.features, chunk_size
+            )
+        yield pd.DataFrame(
+            {
+                "SK_ID_CURR": chunk.SK_ID_CURR.astype(np.int64),
+                "TARGET": chunk.TARGET,
+                "score": scores,
+            }
+        )
+
+
+def export_scores(
+    artifact: model_store.ModelArtifact,
+    output: str,
+    chunk_size: int,
+    filters: Dict[str, Optional[float]],
+) -> Iterator[bytes]:
+    """Yields the scored customers serialized in the output format."""
+    arrow = encoding.ArrowStream() if output == "arrow" else None
+    for position, scored in enumerate(score_chunks(artifact, chunk_size, filters)):
+        with METRICS.timer("serialize"):
+            if arrow:
+                data = arrow.write(scored)
+            elif output == "csv":
+                data = scored.to_csv(index=False, header=position == 0).encode()
+            else:
+                lines = scored.to_json(orient="records", lines=True)
+                # Older pandas versions leave out the last line end.
+                data = (lines if lines.endswith("\n") else lines + "\n").encode()
+        yield data
+    if arrow:
+        yield arrow.close()
+
+
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "arrow": encoding.ARROW_STREAM,
+}
+
+
+@app.get("/export/scores")
+async def export_scored_customers(  # pylint: disable=too-many-arguments
+    request: Request,
+    *,
+    output: Optional[str] = Query(None, regex="^(ndjson|csv|arrow)$"),
+    chunk_size: int = Query(10_000, gt=0),
+    min_id: Optional[int] = None,
+    max_id: Optional[int] = None,
+    target: Optional[float] = None,
+):
+    """Streams every stored customer with its current score as NDJSON, CSV or an
+    Arrow stream. Without output the format follows the Accept header, NDJSON by
+    default.
+
+    Customers can be filtered by an inclusive SK_ID_CURR range and a TARGET value,
+    the whole export is scored by the model served when it started.
+    """
+    if output is None:
+        output = "arrow" if accept_arrow(request) else "ndjson"
+    elif output == "arrow" and not encoding.arrow_available():
+        raise HTTPException(406, "Arrow output needs the pyarrow package")
+    artifact = verify_model()
+    return StreamingResponse(
+        export_scores(
+            artifact,
+            output,
+            chunk_size,
+            {"min_id": min_id, "max_id": max_id, "target": target},
+        ),
+        media_type=EXPORT_MEDIA_TYPES[output],
+        headers={"X-Model-Version": artifact.version},
+    )
+
+
+@app.get("/live")
+async def live():
+    """Liveness check, succeeds as long as the worker answers."""
+    return {"Status": "alive"}
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness check, only succeeds once the model and customers are loaded."""
+    if not ARTIFACT or not STORE:
+        raise HTTPException(503, "Server is not ready")
+    return {"Status": "ready", "model_version": ARTIFACT.version}
+
+
+def record_training_crash(job_id: str, future) -> None:
+    """Marks the job failed if its process died before reporting."""
+    error = future.exception()
+    if error:
+        logger.error("Training job %s crashed, ERROR %s: ", job_id, error)
+        model_store.write_job_status(job_id, status="failed", error=str(error))
+
+
+def new_trainer() -> ProcessPoolExecutor:
+    """Creates the pool running the trainings, one at a time.
+
+    Spawned so the child does not inherit the threads of this worker.
+    """
+    return ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"))
+
+
+@app.post("/train_model", status_code=202)
+async def train_model(incremental: bool = False):
+    """Starts training a new model in a background process.
+
+    The returned job id is used to follow the training, the new model is served by
+    every worker once it is saved. An incremental training only adds trees for the
+    customers saved since the served model was trained.
+    """
+    global TRAINER
+    job_id = uuid.uuid4().hex
+    model_store.write_job_status(job_id, status="queued", stage="queued", progress=0.0)
+    if TRAINER is None:
+        TRAINER = new_trainer()
+    try:
+        future = TRAINER.submit(
+            model_store.run_training_job, job_id, incremental=incremental
+        )
+    except BrokenProcessPool:
+        # The last training process died, killed when out of memory for instance,
+        # which breaks the pool for good.
+        logger.warning("Training process died, starting a new one")
+        TRAINER.shutdown(wait=False)
+        TRAINER = new_trainer()
+        future = TRAINER.submit(
+            model_store.run_training_job, job_id, incremental=incremental
+        )
+    future.add_done_callback(functools.partial(record_training_crash, job_id))
+    logger.info("Training job %s started", job_id)
+    return {"job_id": job_id, "status": "queued"}
+
+
+@app.get("/train_model/{job_id}")
+async def training_status(job_id: str):
+    """Gets the status, stage and progress of a training job."""
+    try:
+        return model_store.read_job_status(job_id)
+    except FileNotFoundError as error:
+        raise HTTPException(404, "Unknown training job") from error
+
+
+@app.post("/model/rollback")
+async def rollback_model(version: Optional[str] = None):
+    """Serves a previous model version again, the one before the current if none
+    is given. Other workers follow on their next check of the latest version.
+    """
+    try:
+        version = model_store.rollback(version)
+    except FileNotFoundError as error:
+        raise HTTPException(404, str(error)) from error
+    except ValueError as error:
+        raise HTTPException(400, str(error)) from error
+    await swap_model(version)
+    return {"Status": "rolled back", "model_version": version}
+
+
+def metrics_path() -> str:
+    """File of the metrics of this worker in METRICS_DIR."""
+    return os.path.join(
+        server_conf.METRICS_DIR, f"{os.getpid()}{metrics.EXPORT_SUFFIX}"
+    )
+
+
+async def export_metrics():
+    """Writes the metrics of this worker for the others to merge."""
+    while True:
+        try:
+            METRICS.write(metrics_path())
+        except OSError as error:
+            logger.error("Cannot export metrics, ERROR %s: ", error)
+        await asyncio.sleep(server_conf.METRICS_EXPORT_SECONDS)
+
+
+@app.on_event("startup")
+async def start_metrics_exporter():
+    """Starts writing the metrics of this worker if they are shared."""
+    global METRICS_EXPORTER
+    if server_conf.METRICS_DIR:
+        METRICS_EXPORTER = asyncio.create_task(export_metrics())
+
+
+@app.on_event("shutdown")
+def stop_metrics_exporter():
+    """Stops writing the metrics, the file is removed by the gunicorn master."""
+    if METRICS_EXPORTER:
+        METRICS_EXPORTER.cancel()
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Returns the request latencies, stage timings, queues, cache ratios and model
+    version in the Prometheus text format.
+
+    With METRICS_DIR the series of every worker are returned with a worker label,
+    the metrics of this worker being written first so they are up to date.
+    """
+    if not server_conf.METRICS_DIR:
+        return Response(METRICS.render(), media_type="text/plain; version=0.0.4")
+    METRICS.write(metrics_path())
+    text = metrics.merge_exports(metrics.read_exports(server_conf.METRICS_DIR))
+    return Response(text, media_type="text/plain; version=0.0.4")
+
+
+@app.get("/metrics/queues")
+async def queue_metrics():
+    """Returns the limit, queue depth and counters of the offloaded operations, of
+    the answering worker only.
+    """
+    return EXECUTOR.metrics()
+
+
+@app.get("/metrics/batching")
+async def batching_metrics():
+    """Returns the batch size and wait time histograms of the micro batching, of
+    the answering worker only.
+    """
+    if not BATCHER:
+        raise HTTPException(404, "Micro batching is not enabled")
+    return {
+        "batch_size": BATCHER.batch_size.to_dict(),
+        "wait_seconds": BATCHER.wait_time.to_dict(),
+    }
@@ -0,0 +1,156 @@
+"""This module keeps the predictions made by the server so later requests, like the
+advisor decision, can refer to them by id from any worker.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Optional
+
+from app import storage
+
+logger = logging.getLogger("ml-app")
+
+SESSIONS_PATH = os.path.join(storage.DATA_DIR, "sessions.sqlite3")
+
+
+@dataclass
+class Prediction:
+    """A scored customer as sent to the prediction endpoint."""
+
+    customer: Dict[str, Optional[float]]
+    score: float
+    created_at: float = field(default_factory=time.time)
+    # Version of the model that gave the score, None if saved before it was kept.
+    model_version: Optional[str] = None
+    # Per feature contributions to the score, computed on the first request.
+    explanation: Optional[Dict[str, Any]] = None
+
+
+class SqliteBackend:
+    """Predictions shared between the workers of a host in a SQLite file.
+
+    Every thread keeps its own connection open, the file is not opened again for
+    each call.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or SESSIONS_PATH
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS predictions "
+                "(id TEXT PRIMARY KEY, created_at REAL, data TEXT)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS predictions_created_at "
+                "ON predictions (created_at)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            self._local.connection = connection
+        return connection
+
+    def set(self, prediction_id: str, prediction: Prediction) -> None:
+        """Saves or replaces a prediction."""
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)",
+                (prediction_id, prediction.created_at, json.dumps(asdict(prediction))),
+            )
+
+    def get(self, prediction_id: str) -> Optional[Prediction]:
+        """Returns a prediction or None if unknown."""
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT data FROM predictions WHERE id = ?", (prediction_id,)
+            ).fetchone()
+        return Prediction(**json.loads(row[0])) if row else None
+
+    def expire(self, before: float) -> None:
+        """Deletes the predictions created before the given time."""
+        with self._connect() as connection:
+            connection.execute(
+                "DELETE FROM predictions WHERE created_at < ?", (before,)
+            )
+
+
+class PredictionSessions:  # pylint: disable=too-many-instance-attributes
+    """In process LRU cache of predictions with an expiry time.
+
+    A shared backend can be given so predictions made by another worker are found
+    too, the cache then only saves the round trips for the local ones.
+    """
+
+    def __init__(
+        self,
+        backend: Optional[SqliteBackend] = None,
+        max_size: int = 10_000,
+        ttl: float = 24 * 3600,
+        expire_every: int = 1000,
+    ):
+        self.backend = backend
+        self.max_size = max_size
+        self.ttl = ttl
+        # Expired predictions are deleted from the backend every expire_every saves.
+        self.expire_every = expire_every
+        self._saves = 0
+        self._cache: OrderedDict[str, Prediction] = OrderedDict()
+        self._lock = threading.Lock()
+        # Lookups answered by the local cache or not.
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, prediction_id: str, prediction: Prediction) -> None:
+        with self._lock:
+            self._cache[prediction_id] = prediction
+            self._cache.move_to_end(prediction_id)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def save(self, prediction: Prediction) -> str:
+        """Keeps a prediction and returns its new id."""
+        prediction_id = uuid.uuid4().hex
+        self._remember(prediction_id, prediction)
+        if self.backend:
+            self.backend.set(prediction_id, prediction)
+            with self._lock:
+                expire = self._saves % self.expire_every == 0
+                self._saves += 1
+            if expire:
+                self.backend.expire(time.time() - self.ttl)
+        return prediction_id
+
+    def update(self, prediction_id: str, prediction: Prediction) -> None:
+        """Replaces a saved prediction, to add its explanation."""
+        self._remember(prediction_id, prediction)
+        if self.backend:
+            self.backend.set(prediction_id, prediction)
+
+    def get(self, prediction_id: str) -> Optional[Prediction]:
+        """Returns a prediction, None if it is unknown or expired."""
+        with self._lock:
+            prediction = self._cache.get(prediction_id)
+            if prediction is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if prediction is None and self.backend:
+            prediction = self.backend.get(prediction_id)
+            if prediction is not None:
+                self._remember(prediction_id, prediction)
+
+        if prediction is None or prediction.created_at < time.time() - self.ttl:
+            return None
+        return prediction
@@ -17,15 +17,52 @@ class Settings(BaseSettings):
     #   le port du dashboard.
     PREDICTION_ENDPOINT: str = "https://pao-app.online/api/make_prediction"
     GET_FI_ENDPOINT: str = "https://pao-app.online/api/get_feature_importance"
+    EXPLAIN_ENDPOINT: str = "https://pao-app.online/api/explain"
     GET_CUSTOMER: str = "https://pao-app.online/api/get_customer"
     GET_ACCEPTED_DESC_ENDPOINT: str = (
         "https://pao-app.online/api/get_accepted_description"
     )
-    TRAINING_ENDPOINT: str = "https://pao-app.online/api/train_model"
+    GET_ACCEPTED_CHART_ENDPOINT: str = "https://pao-app.online/api/get_accepted_chart"
+    # Not exposed by nginx, called from the instance.
+    TRAINING_ENDPOINT: str = "http://localhost:8088/train_model"
+    READY_ENDPOINT: str = "https://pao-app.online/api/ready"
     SAVE_DECISION_ENDPOINT: str = "https://pao-app.online/api/decision"
     AUTH_FILE_PATH: str = "auth_config.yaml"
 
 
+class ServerSettings(BaseSettings):
+    """Prediction server options, can be overridden with environment variables."""
+
+    # Merge the concurrent /make_prediction calls into one model call.
+    MICRO_BATCHING: bool = False
+    BATCH_MAX_WAIT_MS: float = 2.0
+    BATCH_MAX_SIZE: int = 64
+    # How often each worker checks for a new model version.
+    MODEL_POLL_SECONDS: float = 5.0
+    # How often each worker checks for customers saved by the other workers.
+    DATA_POLL_SECONDS: float = 10.0
+    # Share of the request payloads logged at info level, all of them in debug.
+    PAYLOAD_LOG_RATE: float = 0.0
+    # Folder where every worker writes its metrics for /metrics to merge them, the
+    # metrics are the ones of the answering worker only if empty. See gunicorn_conf.py.
+    METRICS_DIR: str = ""
+    # How often each worker writes its metrics to METRICS_DIR.
+    METRICS_EXPORT_SECONDS: float = 5.0
+
+    # Gunicorn production profile, see gunicorn_conf.py.
+    BIND: str = "localhost:8088"
+    # Sized from the CPU count and the request costs below when 0.
+    WORKERS: int = 0
+    # CPU and wall clock milliseconds of a /make_prediction, see risk-benchmark.
+    REQUEST_CPU_MS: float = 2.9
+    REQUEST_WALL_MS: float = 3.0
+    # Workers are replaced after about this many requests, 0 to never recycle.
+    MAX_REQUESTS: int = 10_000
+    MAX_REQUESTS_JITTER: int = 1_000
+    # Seconds a stopping worker waits for the requests in flight.
+    GRACEFUL_TIMEOUT: int = 30
+
+
 class LogConfig(BaseSettings):
     """Logging configuration to be set for the server"""
 
@@ -56,4 +93,5 @@ class LogConfig(BaseSettings):
 
 
 conf = Settings()
+server_conf = ServerSettings()
 log_conf = LogConfig()
@@ -0,0 +1,517 @@
+"""This module contains the storage backends of the customers dataset.
+
+Two backends are available, the original csv files and a columnar layout with one
+memory mapped NumPy file per column. Both return the features joined with the
+TARGET column and both can load only the columns asked for.
+"""
+from __future__ import annotations
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("ml-tools")
+
+DATA_DIR = "app/data"
+TRAIN_PATH = os.path.join(DATA_DIR, "train.csv")
+LABELS_PATH = os.path.join(DATA_DIR, "labels.csv")
+COLUMNAR_DIR = os.path.join(DATA_DIR, "columnar")
+DECISIONS_PATH = os.path.join(DATA_DIR, "decisions.log")
+
+
+def column_dtype(column: str) -> np.dtype:
+    """Type used to load and store a column, following the fields of the Customer
+    model: the id is an int64, the yes/no flags and the label are int8 and the
+    other features float32 like the model matrix.
+    """
+    if column == "SK_ID_CURR":
+        return np.dtype(np.int64)
+    if column.startswith("FLAG_") or column == "TARGET":
+        return np.dtype(np.int8)
+    return np.dtype(np.float32)
+
+
+def schema(columns: List[str]) -> Dict[str, np.dtype]:
+    """Types of the given columns, see column_dtype."""
+    return {column: column_dtype(column) for column in columns}
+
+
+def _complete_size(path: str, record_size: Optional[int] = None) -> int:
+    """Size of the complete lines of a file, or of its complete records of
+    record_size bytes. A partially written end, left by a crash, is removed.
+    """
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb+") as file:
+        size = file.seek(0, os.SEEK_END)
+        if record_size:
+            complete = size // record_size * record_size
+        else:
+            complete = position = size
+            while position > 0:
+                start = max(0, position - 2**16)
+                file.seek(start)
+                end = file.read(position - start).rfind(b"\n")
+                if end >= 0:
+                    complete = start + end + 1
+                    break
+                complete = position = start
+        if complete != size:
+            logger.warning("Removing a partially written end of %s", path)
+            file.truncate(complete)
+    return complete
+
+
+def _count_lines(path: str) -> int:
+    """Counts the complete lines of a file, see _complete_size."""
+    size = _complete_size(path)
+    lines = 0
+    with open(path, "rb") as file:
+        while size > 0:
+            block = file.read(min(size, 2**20))
+            lines += block.count(b"\n")
+            size -= len(block)
+    return lines
+
+
+def _append_synced(path: str, rows: pd.DataFrame) -> None:
+    with open(path, "a", encoding="utf-8") as file:
+        rows.to_csv(file, index=False, header=False)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+class CsvBackend:
+    """Customers stored in the train.csv features file and the labels.csv file."""
+
+    def __init__(
+        self, train_path: Optional[str] = None, labels_path: Optional[str] = None
+    ):
+        self.train_path = train_path or TRAIN_PATH
+        self.labels_path = labels_path or LABELS_PATH
+
+    def read(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Reads the customers, only the given columns if any."""
+        train_columns = (
+            None if columns is None else [c for c in columns if c != "TARGET"]
+        )
+        try:
+            header = pd.read_csv(self.train_path, nrows=0).columns
+            data = pd.read_csv(
+                self.train_path, usecols=train_columns, dtype=schema(list(header))
+            )
+            if columns is None or "TARGET" in columns:
+                data["TARGET"] = pd.read_csv(
+                    self.labels_path, dtype=schema(["TARGET"])
+                ).TARGET.values
+        except FileNotFoundError as error:
+            logger.error("Cannot read features file, ERROR %s: ", error)
+            raise
+        return data if columns is None else data[columns]
+
+    def rows(self) -> int:
+        """Number of stored customers."""
+        return _count_lines(self.train_path) - 1
+
+    def append(self, rows: pd.DataFrame, start: Optional[int] = None) -> None:
+        """Appends rows holding every feature and the TARGET column, written to the
+        disk before returning.
+
+        When start, the number of customers before these rows, is given the rows
+        already written by an interrupted append are skipped in each file.
+        """
+        header = list(pd.read_csv(self.train_path, nrows=0).columns)
+        for path, columns in [
+            (self.train_path, header),
+            (self.labels_path, ["TARGET"]),
+        ]:
+            written = 0 if start is None else _count_lines(path) - 1 - start
+            _append_synced(path, rows[columns].iloc[written:])
+
+
+class ColumnarBackend:
+    """Customers stored as one .npy file per column, memory mapped on read.
+
+    New rows are written to an append log of fixed width float64 records in the
+    schema column order, a partially written last record is ignored on read.
+    """
+
+    SCHEMA_FILE = "schema.json"
+    LOG_FILE = "append.log"
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path = path or COLUMNAR_DIR
+        with open(os.path.join(path, self.SCHEMA_FILE), encoding="utf-8") as file:
+            stored = json.load(file)
+        self.columns: List[str] = stored["columns"]
+        # Rows of the .npy files.
+        self.base_rows: int = stored["rows"]
+        self.log_path = os.path.join(path, self.LOG_FILE)
+
+    def read_log(self) -> np.ndarray:
+        """Reads the appended rows, one float64 record per row in schema order."""
+        if not os.path.exists(self.log_path):
+            return np.empty((0, len(self.columns)))
+        records = np.fromfile(self.log_path, dtype=np.float64)
+        complete = len(records) // len(self.columns) * len(self.columns)
+        return records[:complete].reshape(-1, len(self.columns))
+
+    def read(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Reads the customers, only the given columns if any."""
+        columns = columns or self.columns
+        log = self.read_log()
+        data = {}
+        for column in columns:
+            values = np.load(os.path.join(self.path, f"{column}.npy"), mmap_mode="r")
+            appended = log[:, self.columns.index(column)].astype(values.dtype)
+            data[column] = np.concatenate([values, appended])
+        return pd.DataFrame(data)
+
+    def rows(self) -> int:
+        """Number of stored customers."""
+        record_size = 8 * len(self.columns)
+        return (
+            self.base_rows + _complete_size(self.log_path, record_size) // record_size
+        )
+
+    def append(self, rows: pd.DataFrame, start: Optional[int] = None) -> None:
+        """Appends rows holding every column of the schema to the log, written to
+        the disk before returning.
+
+        When start, the number of customers before these rows, is given the rows
+        already written by an interrupted append are skipped.
+        """
+        written = 0 if start is None else self.rows() - start
+        records = rows[self.columns].iloc[written:].to_numpy(dtype=np.float64)
+        with open(self.log_path, "ab") as file:
+            file.write(records.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def get_backend():
+    """Returns the columnar backend once the data was migrated, the csv one if not."""
+    if os.path.exists(os.path.join(COLUMNAR_DIR, ColumnarBackend.SCHEMA_FILE)):
+        return ColumnarBackend()
+    return CsvBackend()
+
+
+def _read_records(path: str, offset: int) -> Tuple[List[Dict[str, Any]], int]:
+    """Reads the JSON lines of a file after offset, returns them with the offset
+    after the last complete line, -1 if the file is shorter than offset.
+    """
+    if not os.path.exists(path):
+        return [], offset if offset == 0 else -1
+    with open(path, "rb") as file:
+        if file.seek(0, os.SEEK_END) < offset:
+            return [], -1
+        file.seek(offset)
+        data = file.read()
+    complete = data.rfind(b"\n") + 1
+    records = []
+    for line in data[:complete].splitlines():
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            logger.warning("Skipping invalid decision record")
+    return records, offset + complete
+
+
+class DecisionLog:
+    """Write ahead log of the advisor decisions.
+
+    Each decision is one JSON line holding the features and the label of a customer,
+    so features and labels can not get out of alignment. Every access locks a side
+    file, shared to read and exclusive to write, which makes the log safe to use from
+    several server workers.
+
+    A compaction moves the log to the backend and starts a new generation of the
+    log, the previous one is kept as the .prev file. Its progress is written to a
+    state file so a compaction interrupted by a crash is finished by the next one
+    without appending a row twice.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path = path or DECISIONS_PATH
+        self.lock_path = f"{path}.lock"
+        self.prev_path = f"{path}.prev"
+        self.state_path = f"{path}.state"
+
+    @contextmanager
+    def locked(self, operation: int = fcntl.LOCK_EX) -> Iterator[None]:
+        """Holds the log lock, exclusive by default."""
+        with open(self.lock_path, "a", encoding="utf-8") as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def state_unlocked(self) -> Dict[str, Any]:
+        """Returns the generation of the log and the progress of its compaction,
+        the caller must hold the lock.
+        """
+        if not os.path.exists(self.state_path):
+            return {"generation": 0}
+        with open(self.state_path, encoding="utf-8") as file:
+            return json.load(file)
+
+    def _write_state(self, state: Dict[str, Any]) -> None:
+        with open(f"{self.state_path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f"{self.state_path}.tmp", self.state_path)
+
+    def _next_generation(self) -> None:
+        # Once the backend holds the whole log, the log becomes the previous one.
+        state = self.state_unlocked()
+        if not state.get("compacted"):
+            return
+        if os.path.exists(self.path):
+            os.replace(self.path, self.prev_path)
+        self._write_state({"generation": state["generation"] + 1})
+
+    def append(self, records: List[Dict[str, Optional[float]]]) -> None:
+        """Writes the records and waits for them to reach the disk."""
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with self.locked():
+            self._next_generation()
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(lines)
+                file.flush()
+                os.fsync(file.fileno())
+
+    def read_unlocked(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Reads the pending decisions, the caller must hold the lock.
+
+        A partially written last line is skipped, the decisions already in the
+        backend of an unfinished compaction are not pending.
+        """
+        records: List[Dict[str, Any]] = []
+        if not self.state_unlocked().get("compacted"):
+            records, _ = _read_records(self.path, 0)
+        data = pd.DataFrame(records)
+        return data if columns is None or data.empty else data[columns]
+
+    def position_unlocked(self) -> Tuple[int, int]:
+        """Generation of the log and size of its complete lines, the position after
+        the decisions read so far. The caller must hold the lock.
+        """
+        _, end = _read_records(self.path, 0)
+        return self.state_unlocked()["generation"], end
+
+    def read_since_unlocked(
+        self, position: Tuple[int, int]
+    ) -> Optional[Tuple[pd.DataFrame, Tuple[int, int]]]:
+        """Reads the decisions written after a position, with the new position. The
+        caller must hold the lock.
+
+        Decisions compacted once since are read from the previous log, None is
+        returned if some of them are in neither log anymore.
+        """
+        generation, offset = position
+        current = self.state_unlocked()["generation"]
+        if current == generation:
+            records, end = _read_records(self.path, offset)
+        elif current == generation + 1:
+            records, _ = _read_records(self.prev_path, offset)
+            newer, end = _read_records(self.path, 0)
+            records += newer
+        else:
+            return None
+        if end < 0:
+            return None
+        return pd.DataFrame(records), (current, end)
+
+    def compact(self, backend) -> int:
+        """Moves the pending decisions to the backend and starts a new log."""
+        with self.locked():
+            self._next_generation()
+            pending = self.read_unlocked()
+            if pending.empty:
+                return 0
+            state = self.state_unlocked()
+            if "rows" not in state:
+                # Appending again after a crash skips the rows written past it.
+                state["rows"] = backend.rows()
+                self._write_state(state)
+            backend.append(pending, state["rows"])
+            self._write_state({**state, "compacted": True})
+            self._next_generation()
+        logger.info("Compacted %s decisions", len(pending))
+        return len(pending)
+
+
+class DecisionWriter:
+    """Background thread writing decisions to the log.
+
+    Records received within flush_interval seconds are written together with a
+    single fsync, the log is compacted into the backend, the active one if not
+    given, every compact_interval seconds and when the writer stops.
+    """
+
+    def __init__(
+        self,
+        log: Optional[DecisionLog] = None,
+        backend=None,
+        flush_interval: float = 0.05,
+        compact_interval: float = 300.0,
+    ):
+        self.log = log or DecisionLog()
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self._queue: queue.Queue = queue.Queue()
+        self._last_compaction = time.monotonic()
+        self._thread = threading.Thread(
+            target=self._run, name="decision-writer", daemon=True
+        )
+
+    def start(self) -> None:
+        """Starts the writer thread."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Writes the queued records, compacts the log and stops the thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def submit(self, record: Dict[str, Optional[float]]) -> None:
+        """Queues a record, returns without waiting for the disk."""
+        self._queue.put(record)
+
+    def _next_batch(self) -> Tuple[List[Dict[str, Optional[float]]], bool]:
+        """Waits for records until the next compaction is due, then collects the
+        ones arriving within flush_interval. Returns them and whether to stop.
+        """
+        batch: List[Dict[str, Optional[float]]] = []
+        timeout = self._last_compaction + self.compact_interval - time.monotonic()
+        try:
+            record = self._queue.get(timeout=max(0.0, timeout))
+        except queue.Empty:
+            return batch, False
+
+        deadline = time.monotonic() + self.flush_interval
+        while record is not None:
+            batch.append(record)
+            try:
+                record = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            try:
+                if batch:
+                    self.log.append(batch)
+                due = self._last_compaction + self.compact_interval
+                if stop or time.monotonic() >= due:
+                    self.log.compact(self.backend or get_backend())
+                    self._last_compaction = time.monotonic()
+            except Exception as error:  # pylint: disable=broad-except
+                # The thread must survive to write the next decisions.
+                logger.error("Cannot write decisions, ERROR %s: ", error)
+
+
+def read_customers(columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Reads the stored customers followed by the decisions not compacted yet."""
+    return read_customers_at(columns)[0]
+
+
+def read_customers_at(
+    columns: Optional[List[str]] = None,
+) -> Tuple[pd.DataFrame, Tuple[int, int]]:
+    """Reads the stored customers like read_customers, with the position in the
+    decision log to read the next decisions from, see read_decisions_since.
+    """
+    log = DecisionLog()
+    with log.locked(fcntl.LOCK_SH):
+        data = get_backend().read(columns)
+        pending = log.read_unlocked(columns)
+        position = log.position_unlocked()
+    if pending.empty:
+        return data, position
+    data = pd.concat([data, pending.astype(data.dtypes.to_dict())], ignore_index=True)
+    return data, position
+
+
+def read_decisions_since(
+    position: Tuple[int, int]
+) -> Optional[Tuple[pd.DataFrame, Tuple[int, int]]]:
+    """Reads the decisions saved after a position of the decision log, only the end
+    of the log is read. None if they can not all be read anymore, after two
+    compactions for instance.
+    """
+    log = DecisionLog()
+    with log.locked(fcntl.LOCK_SH):
+        return log.read_since_unlocked(position)
+
+
+def migrate_csv(
+    source: CsvBackend,
+    path: Optional[str] = None,
+    log: Optional[DecisionLog] = None,
+) -> ColumnarBackend:
+    """Converts the csv files to the columnar layout.
+
+    Files are written to a temporary directory that replaces the target at the end.
+    A target already migrated only receives new rows in its append log, it is then
+    rebuilt from itself with the log folded in and the csv files are not read. The
+    decision log lock is held all along so no decision is compacted meanwhile.
+    """
+    path = path or COLUMNAR_DIR
+    with (log or DecisionLog()).locked():
+        if os.path.exists(os.path.join(path, ColumnarBackend.SCHEMA_FILE)):
+            logger.info("%s already migrated, folding its append log", path)
+            data = ColumnarBackend(path).read()
+        else:
+            data = source.read()
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        for column in data.columns:
+            np.save(
+                os.path.join(tmp_path, f"{column}.npy"),
+                data[column].to_numpy(dtype=column_dtype(column)),
+            )
+        with open(
+            os.path.join(tmp_path, ColumnarBackend.SCHEMA_FILE), "w", encoding="utf-8"
+        ) as file:
+            json.dump({"columns": list(data.columns), "rows": len(data)}, file)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+    logger.info("Migrated %s rows to %s", len(data), path)
+    return ColumnarBackend(path)
+
+
+def main(args: Optional[List[str]] = None):
+    """Command line entry point to migrate the csv files to the columnar layout."""
+    parser = argparse.ArgumentParser(description="Migrate csv data to columnar.")
+    parser.add_argument("--train", default=TRAIN_PATH)
+    parser.add_argument("--labels", default=LABELS_PATH)
+    parser.add_argument("--output", default=COLUMNAR_DIR)
+    options = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    migrate_csv(CsvBackend(options.train, options.labels), options.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""This module searches the random forest parameters with cross validation.
+
+The candidates are evaluated in a pool of processes. The training matrix is written
+once to NumPy files that every worker memory maps read only, so the data is shared
+through the page cache instead of being pickled to each worker. The best candidate
+is trained again on all the rows and saved with its scores as the latest model.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Any, Deque, Dict, List, Optional
+
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import ParameterGrid, StratifiedKFold
+
+from app import ml_tools, model_store
+
+logger = logging.getLogger("ml-tools")
+
+TUNING_DIR = "tuning"
+PARAM_GRID = {
+    "n_estimators": [5, 20, 50],
+    "max_depth": [None, 12],
+    "min_samples_leaf": [1, 20],
+    "max_features": ["sqrt", 0.5],
+}
+
+# Training data of the current worker process, opened by the pool initializer.
+_MATRIX: Optional[np.ndarray] = None
+_TARGET: Optional[np.ndarray] = None
+
+
+@dataclass
+class Candidate:
+    """Cross validation result of one set of parameters."""
+
+    params: Dict[str, Any]
+    roc_auc: float
+    roc_auc_std: float
+    seconds: float
+    # Largest NumPy allocation while evaluating, the shared matrix is not counted.
+    peak_alloc_mb: float
+    # Peak resident memory of the worker since it started.
+    peak_rss_mb: float
+
+
+def share_data(matrix: np.ndarray, target: np.ndarray, directory: str) -> List[str]:
+    """Writes the training data to NumPy files the workers can memory map."""
+    paths = [os.path.join(directory, name) for name in ["matrix.npy", "target.npy"]]
+    np.save(paths[0], np.ascontiguousarray(matrix, dtype=np.float32))
+    np.save(paths[1], np.asarray(target, dtype=np.int8).ravel())
+    return paths
+
+
+def _open_shared_data(matrix_path: str, target_path: str) -> None:
+    global _MATRIX, _TARGET
+    _MATRIX = np.load(matrix_path, mmap_mode="r")
+    _TARGET = np.load(target_path, mmap_mode="r")
+
+
+def evaluate(params: Dict[str, Any], folds: int, seed: int) -> Candidate:
+    """Cross validates a forest on the data of the worker and measures it."""
+    start = time.perf_counter()
+    tracemalloc.start()
+    scores = []
+    splits = StratifiedKFold(folds, shuffle=True, random_state=seed)
+    for train, test in splits.split(np.zeros(len(_TARGET)), _TARGET):
+        # The pool already uses every core, the forest must not add threads.
+        model = RandomForestClassifier(random_state=seed, n_jobs=1, **params)
+        model.fit(_MATRIX[train], _TARGET[train])
+        scores.append(
+            roc_auc_score(_TARGET[test], model.predict_proba(_MATRIX[test])[:, 1])
+        )
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return Candidate(
+        params=params,
+        roc_auc=round(float(np.mean(scores)), 5),
+        roc_auc_std=round(float(np.std(scores)), 5),
+        seconds=round(time.perf_counter() - start, 2),
+        peak_alloc_mb=round(peak / 2**20, 1),
+        peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    )
+
+
+def candidates(
+    grid: Dict[str, List[Any]], n_candidates: Optional[int] = None, seed: int = 0
+) -> List[Dict[str, Any]]:
+    """Lists the parameters to try, a random subset of the grid if n_candidates."""
+    params = list(ParameterGrid(grid))
+    if n_candidates is not None and n_candidates < len(params):
+        params = random.Random(seed).sample(params, n_candidates)
+    return params
+
+
+def search(  # pylint: disable=too-many-arguments, too-many-locals
+    matrix: np.ndarray,
+    target: np.ndarray,
+    params: List[Dict[str, Any]],
+    *,
+    folds: int = 3,
+    workers: Optional[int] = None,
+    time_budget: Optional[float] = None,
+    seed: int = 0,
+) -> List[Candidate]:
+    """Evaluates the parameters in a pool of processes, best candidates first.
+
+    No new candidate is started once time_budget seconds have passed, the ones
+    running are finished.
+    """
+    workers = workers or os.cpu_count() or 1
+    results: List[Candidate] = []
+    pending: Deque[Future] = deque()
+    start = time.perf_counter()
+
+    def collect():
+        candidate = pending.popleft().result()
+        logger.info("%s", candidate)
+        results.append(candidate)
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = share_data(matrix, target, directory)
+        with ProcessPoolExecutor(
+            workers, initializer=_open_shared_data, initargs=paths
+        ) as pool:
+            for position, param in enumerate(params):
+                if time_budget and time.perf_counter() - start > time_budget:
+                    logger.warning(
+                        "Time budget spent, %s candidates skipped",
+                        len(params) - position,
+                    )
+                    break
+                pending.append(pool.submit(evaluate, param, folds, seed))
+                if len(pending) >= workers:
+                    collect()
+            while pending:
+                collect()
+
+    return sorted(results, key=lambda candidate: candidate.roc_auc, reverse=True)
+
+
+def tune(  # pylint: disable=too-many-arguments, too-many-locals
+    *,
+    grid: Optional[Dict[str, List[Any]]] = None,
+    n_candidates: Optional[int] = None,
+    folds: int = 3,
+    workers: Optional[int] = None,
+    time_budget: Optional[float] = None,
+    model_dir: str = model_store.MODEL_DIR,
+) -> model_store.ModelArtifact:
+    """Searches the parameters on the dataset, saves the best model as the latest
+    one with its scores and writes the report of every candidate next to it.
+    """
+    train, target = ml_tools.load_data()
+    rows = len(train)
+    train, preprocessor = ml_tools.prepare_train_data(train)
+    results = search(
+        train.to_numpy(),
+        target.TARGET.to_numpy(),
+        candidates(grid or PARAM_GRID, n_candidates),
+        folds=folds,
+        workers=workers,
+        time_budget=time_budget,
+    )
+    if not results:
+        raise ValueError("No candidate evaluated within the time budget")
+
+    best = results[0]
+    logger.info("Training the best candidate on all the rows: %s", best.params)
+    model = ml_tools.train_model(train, target, best.params)
+    metrics = {"folds": folds, **asdict(best)}
+    artifact = model_store.new_artifact(model, preprocessor, rows, metrics)
+    model_store.save_artifact(artifact, model_dir)
+
+    os.makedirs(os.path.join(model_dir, TUNING_DIR), exist_ok=True)
+    report_path = os.path.join(model_dir, TUNING_DIR, f"{artifact.version}.json")
+    with open(report_path, "w", encoding="utf-8") as file:
+        json.dump([asdict(result) for result in results], file, indent=2)
+    return artifact
+
+
+def main(args: Optional[List[str]] = None):
+    """Command line entry point to search the model parameters."""
+    parser = argparse.ArgumentParser(description="Search the risk model parameters.")
+    parser.add_argument("--candidates", type=int, help="random subset of the grid")
+    parser.add_argument("--folds", type=int, default=3)
+    parser.add_argument("--workers", type=int, help="processes, all cores if not set")
+    parser.add_argument("--time-budget", type=float, help="seconds to start candidates")
+    parser.add_argument(
+        "--grid", help="JSON object of the values to try by parameter, see PARAM_GRID"
+    )
+    parser.add_argument("--model-dir", default=model_store.MODEL_DIR)
+    options = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    tune(
+        grid=json.loads(options.grid) if options.grid else None,
+        n_candidates=options.candidates,
+        folds=options.folds,
+        workers=options.workers,
+        time_budget=options.time_budget,
+        model_dir=options.model_dir,
+    )
+
+
+if __name__ == "__main__":
+    main()
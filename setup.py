@@ -12,6 +12,8 @@ setup(
     install_requires=[
         "fastapi",
         "gunicorn",
+        "httpx",
+        "orjson",
         "pandas",
         "pydantic",
         "pytest",
@@ -24,4 +26,14 @@ setup(
         "pyyaml",
         "plotly",
     ],
+    extras_require={"parquet": ["pyarrow"], "arrow": ["pyarrow"]},
+    entry_points={
+        "console_scripts": [
+            "risk-train=app.model_store:main",
+            "risk-migrate-data=app.storage:main",
+            "risk-benchmark=app.benchmark:main",
+            "risk-score=app.bulk_score:main",
+            "risk-tune=app.tuning:main",
+        ],
+    },
 )
@@ -1,7 +1,103 @@
+import asyncio
+import io
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, replace
+
+import joblib
+import numpy as np
 import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
 from sklearn.ensemble import RandomForestClassifier
 
-from app import ml_tools
+from app import (
+    batching,
+    benchmark,
+    bulk_score,
+    encoding,
+    executor,
+    forest,
+    gunicorn_conf,
+    metrics,
+    ml_tools,
+    model_store,
+    prediction_server,
+    sessions,
+    storage,
+    tuning,
+)
+
+CUSTOMER = {
+    "SK_ID_CURR": 100002,
+    "FLAG_OWN_CAR": 1,
+    "FLAG_OWN_REALTY": 1,
+    "CNT_CHILDREN": 1,
+    "AMT_INCOME_TOTAL": 156821.8,
+    "AMT_CREDIT": 356808.6,
+    "EXT_SOURCE_1": None,
+    "DAYS_BIRTH": -16232,
+    "ANNUITY_INCOME_PERC": 0.16,
+    "DAYS_EMPLOYED_PERC": 0.13,
+    "INCOME_CREDIT_PERC": 0.44,
+    "PAYMENT_RATE": 0.07,
+    "AMT_ANNUITY": 25072.6,
+    "TARGET": None,
+}
+# Customers copied from the data files for the API tests.
+API_CUSTOMERS = 200
+
+
+@pytest.fixture(scope="module")
+def api(tmp_path_factory):
+    """Client of the server started on the first customers of the data files, its
+    data, models and predictions are kept in a temporary folder. Started once for
+    the module, the shutdown stops the executor for good.
+    """
+    folder = tmp_path_factory.mktemp("api")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for name in ["TRAIN_PATH", "LABELS_PATH"]:
+            source = getattr(storage, name)
+            copy = folder / os.path.basename(source)
+            with open(source, encoding="utf-8") as file:
+                copy.write_text("".join(itertools.islice(file, API_CUSTOMERS + 1)))
+            monkeypatch.setattr(storage, name, str(copy))
+        monkeypatch.setattr(storage, "COLUMNAR_DIR", str(folder / "columnar"))
+        monkeypatch.setattr(storage, "DECISIONS_PATH", str(folder / "decisions.log"))
+        monkeypatch.setattr(sessions, "SESSIONS_PATH", str(folder / "sessions.sqlite3"))
+        monkeypatch.setattr(model_store, "MODEL_DIR", str(folder / "models"))
+        # Set by the startup, put back afterwards.
+        for name in [
+            "ARTIFACT",
+            "SESSIONS",
+            "STORE",
+            "STATS",
+            "WRITER",
+            "BATCHER",
+            "TRAINER",
+            "MODEL_WATCHER",
+            "DATA_WATCHER",
+        ]:
+            monkeypatch.setattr(
+                prediction_server, name, getattr(prediction_server, name)
+            )
+        with TestClient(prediction_server.app) as client:
+            yield client
+
+
+class DeadPool:
+    """Process pool whose process was killed."""
+
+    def submit(self, *args, **kwargs):
+        raise BrokenProcessPool("A child process terminated abruptly")
+
+    def shutdown(self, wait=True):
+        pass
 
 
 class TestMlTools:
@@ -33,3 +129,752 @@ class TestMlTools:
         assert isinstance(model, RandomForestClassifier)
         assert (predict_proba == [0.6, 0.4]).all()
         assert predict[0] == 0
+
+    def test_customer_store_syncs_rows_of_other_workers(self):
+        data = pd.DataFrame(
+            {"SK_ID_CURR": [1, 2], "EXT_SOURCE_1": [0.5, 0.1], "TARGET": [0.0, 1.0]}
+        )
+        store = ml_tools.CustomerStore(data)
+        store.append({"SK_ID_CURR": 1, "EXT_SOURCE_1": 0.7, "TARGET": 0.0})
+        other = {"SK_ID_CURR": 2, "EXT_SOURCE_1": None, "TARGET": 0.0}
+        # Read back from the decision log, the row of the other worker came first.
+        saved = pd.DataFrame(
+            [other, {"SK_ID_CURR": 1, "EXT_SOURCE_1": 0.7, "TARGET": 0.0}]
+        )
+
+        assert store.sync(saved, (0, 100)) == [
+            {"SK_ID_CURR": 2.0, "EXT_SOURCE_1": None, "TARGET": 0.0}
+        ]
+        assert store.sync(pd.DataFrame(), (0, 100)) == []
+        assert store.log_position == (0, 100)
+        assert len(store) == 4
+        assert len(store.get(2)) == 2
+
+    def test_customer_store(self):
+        data = pd.DataFrame(
+            {
+                "SK_ID_CURR": [100002, 100003],
+                "EXT_SOURCE_1": [0.5, float("nan")],
+                "TARGET": [1.0, 0.0],
+            }
+        )
+        store = ml_tools.CustomerStore(data)
+
+        assert 100002 in store
+        assert store.get(100002) == [
+            {"SK_ID_CURR": 100002, "EXT_SOURCE_1": 0.5, "TARGET": 1.0}
+        ]
+
+        store.append({"SK_ID_CURR": 100002.0, "EXT_SOURCE_1": 0.7, "TARGET": None})
+        rows = store.get(100002)
+        assert len(store) == 3
+        assert len(rows) == 2
+        assert rows[-1]["EXT_SOURCE_1"] == 0.7
+        assert store.get(100003)[0]["EXT_SOURCE_1"] is None
+
+        with pytest.raises(ValueError):
+            store.get(999999)
+
+    def test_customer_store_iter_chunks_filters(self):
+        data = pd.DataFrame(
+            {
+                "SK_ID_CURR": [1, 2, 3, 4, 5],
+                "AMT_CREDIT": [1.0, 2.0, 3.0, 4.0, 5.0],
+                "TARGET": [0.0, 1.0, 0.0, 1.0, 0.0],
+            }
+        )
+        store = ml_tools.CustomerStore(data)
+
+        chunks = list(store.iter_chunks(2, min_id=2, target=0.0))
+
+        assert [len(chunk) for chunk in chunks] == [1, 1]
+        assert pd.concat(chunks).SK_ID_CURR.tolist() == [3, 5]
+        assert len(list(store.iter_chunks(2, max_id=0))) == 0
+
+    def test_save_and_load_artifact(self, tmp_path):
+        data = pd.DataFrame({"AMT_CREDIT": [1.0, 2.0, 3.0, 4.0]})
+        train, preprocessor = ml_tools.prepare_train_data(
+            data.assign(SK_ID_CURR=[1, 2, 3, 4])
+        )
+        artifact = model_store.ModelArtifact(
+            model=ml_tools.train_model(train, [0, 0, 1, 1]),
+            preprocessor=preprocessor,
+            features=list(train.columns),
+            version="1",
+            created_at="",
+        )
+
+        model_store.save_artifact(artifact, str(tmp_path))
+        loaded = model_store.load_artifact(model_dir=str(tmp_path))
+
+        assert model_store.list_versions(str(tmp_path)) == ["1"]
+        assert loaded.features == ["AMT_CREDIT"]
+        assert loaded.importance_etag == artifact.importance_etag
+        importance = pd.DataFrame(json.loads(loaded.importance_payload))
+        assert importance.feature.tolist() == ["AMT_CREDIT"]
+        assert (
+            loaded.model.predict_proba(train) == artifact.model.predict_proba(train)
+        ).all()
+
+        # The payload is rebuilt from the model, artifacts saving it are older.
+        path = tmp_path / "model-1.joblib"
+        saved = joblib.load(path)
+        assert "importance_payload" not in saved
+        joblib.dump({**saved, "importance_payload": b"[]"}, path)
+        with pytest.raises(ValueError):
+            model_store.load_artifact(model_dir=str(tmp_path))
+
+    def test_bulk_score_keeps_input_order(self, tmp_path):
+        data = pd.DataFrame(
+            {
+                "SK_ID_CURR": np.arange(10),
+                "AMT_CREDIT": np.arange(10.0),
+                "TARGET": [0.0, 1.0] * 5,
+            }
+        )
+        train, preprocessor = ml_tools.prepare_train_data(data)
+        artifact = model_store.ModelArtifact(
+            model=ml_tools.train_model(train, data.TARGET),
+            preprocessor=preprocessor,
+            features=preprocessor.features,
+            version="1",
+            created_at="",
+        )
+        model_store.save_artifact(artifact, str(tmp_path))
+        data.drop(columns="TARGET").to_csv(tmp_path / "input.csv", index=False)
+
+        rows = bulk_score.score_file(
+            str(tmp_path / "input.csv"),
+            str(tmp_path / "scores.csv"),
+            workers=2,
+            chunk_size=3,
+            model_dir=str(tmp_path),
+        )
+        scores = pd.read_csv(tmp_path / "scores.csv")
+
+        assert rows == 10
+        assert scores.SK_ID_CURR.tolist() == list(range(10))
+        np.testing.assert_allclose(
+            scores.score, artifact.model.predict_proba(train)[:, 1]
+        )
+
+    def test_tuning_search_ranks_candidates(self):
+        rng = np.random.default_rng(0)
+        matrix = rng.normal(size=(200, 3))
+        target = (matrix[:, 0] > 0).astype(int)
+        params = tuning.candidates({"n_estimators": [1, 10], "max_depth": [1, 4]}, 3)
+
+        results = tuning.search(matrix, target, params, folds=2, workers=2)
+
+        assert len(results) == 3
+        assert [result.roc_auc for result in results] == sorted(
+            (result.roc_auc for result in results), reverse=True
+        )
+        assert results[0].roc_auc > 0.9
+        assert all(result.peak_alloc_mb > 0 for result in results)
+
+    def test_rollback_and_job_status(self, tmp_path):
+        train = pd.DataFrame({"AMT_CREDIT": [1.0, 2.0, 3.0, 4.0]})
+        model = ml_tools.train_model(train, [0, 0, 1, 1])
+        for version in ["1", "2"]:
+            artifact = model_store.ModelArtifact(
+                model=model,
+                preprocessor=None,
+                features=["AMT_CREDIT"],
+                version=version,
+                created_at="",
+            )
+            model_store.save_artifact(artifact, str(tmp_path))
+
+        assert model_store.rollback(model_dir=str(tmp_path)) == "1"
+        assert model_store.latest_version(str(tmp_path)) == "1"
+        with pytest.raises(ValueError):
+            model_store.rollback(model_dir=str(tmp_path))
+        with pytest.raises(FileNotFoundError):
+            model_store.set_latest("3", str(tmp_path))
+
+        model_store.write_job_status("job", str(tmp_path), status="queued")
+        model_store.write_job_status("job", str(tmp_path), progress=0.5)
+        assert model_store.read_job_status("job", str(tmp_path)) == {
+            "job_id": "job",
+            "status": "queued",
+            "progress": 0.5,
+        }
+
+    def test_update_artifact_adds_trees_for_new_rows(self):
+        rng = np.random.default_rng(0)
+        data = pd.DataFrame(
+            {
+                "SK_ID_CURR": np.arange(1200),
+                "AMT_CREDIT": rng.normal(size=1200),
+                "TARGET": np.tile([0.0, 1.0], 600),
+            }
+        )
+        train, target = data.drop(columns="TARGET"), data[["TARGET"]]
+        train, preprocessor = ml_tools.prepare_train_data(train.iloc[:1000])
+        artifact = model_store.ModelArtifact(
+            model=ml_tools.train_model(train, target.iloc[:1000].TARGET),
+            preprocessor=preprocessor,
+            features=["AMT_CREDIT"],
+            version="1",
+            created_at="",
+            trained_rows=1000,
+        )
+
+        assert model_store.update_artifact(artifact, data.iloc[:1050]) is None
+        updated = model_store.update_artifact(artifact, data, new_trees=3)
+
+        assert updated.trained_rows == 1200
+        assert len(updated.model.estimators_) == 8
+        assert len(artifact.model.estimators_) == 5
+        drifted = data.assign(AMT_CREDIT=data.AMT_CREDIT + 5 * (data.index >= 1000))
+        retrained = model_store.update_artifact(artifact, drifted)
+        assert len(retrained.model.estimators_) == 5
+
+        params = {"n_estimators": 50, "max_depth": 3}
+        tuned = model_store.ModelArtifact(
+            model=ml_tools.train_model(train, target.iloc[:1000].TARGET, params),
+            preprocessor=preprocessor,
+            features=["AMT_CREDIT"],
+            version="2",
+            created_at="",
+            trained_rows=1000,
+            metrics={"params": params, "roc_auc": 0.7},
+        )
+        updated = model_store.update_artifact(tuned, data)
+        assert len(updated.model.estimators_) == 52
+        assert updated.metrics == {"params": params}
+        retrained = model_store.update_artifact(tuned, drifted)
+        assert len(retrained.model.estimators_) == 50
+        assert retrained.model.max_depth == 3
+
+    def test_predict_batch_matches_single_predictions(self):
+        from app.prediction_server import Customer
+
+        features = ["AMT_CREDIT", "AMT_ANNUITY"]
+        train = pd.DataFrame({"AMT_CREDIT": [1.0, 2.0, 3.0, 4.0], "AMT_ANNUITY": 1.0})
+        model = ml_tools.train_model(train, [0, 0, 1, 1])
+        customers = [
+            Customer.construct(AMT_CREDIT=credit, AMT_ANNUITY=1.0)
+            for credit in [4.0, 1.0, 3.0]
+        ]
+
+        matrix = ml_tools.customers_to_matrix(customers, features)
+        scores = ml_tools.predict_batch(model, matrix, features, chunk_size=2)
+
+        assert matrix.dtype == "float32"
+        assert list(scores) == list(
+            model.predict_proba(pd.DataFrame(matrix, columns=features))[:, 1]
+        )
+
+    def test_preprocessor_imputes_rows_like_training(self):
+        from app.prediction_server import Customer
+
+        data = pd.DataFrame(
+            {
+                "SK_ID_CURR": [1, 2, 3],
+                "EXT_SOURCE_1": [0.2, np.nan, 0.6],
+                "AMT_CREDIT": [1.0, 2.0, 3.0],
+                "TARGET": [0.0, 1.0, 0.0],
+            }
+        )
+        train, preprocessor = ml_tools.prepare_train_data(data)
+        customer = Customer.construct(AMT_CREDIT=5.0, EXT_SOURCE_1=None)
+
+        assert list(train.columns) == ["EXT_SOURCE_1", "AMT_CREDIT"]
+        assert train.EXT_SOURCE_1.tolist() == pytest.approx([0.2, 0.4, 0.6])
+        assert preprocessor.transform_customers([customer]).tolist() == [
+            pytest.approx([0.4, 5.0])
+        ]
+        assert "SK_ID_CURR" in data
+
+    def test_accepted_stats_incremental_update(self):
+        data = pd.DataFrame(
+            {
+                "SK_ID_CURR": [1, 2, 3],
+                "FLAG_OWN_CAR": [0.0, 1.0, 1.0],
+                "FLAG_OWN_REALTY": [1.0, 1.0, 0.0],
+                "CNT_CHILDREN": [0.0, 2.0, 1.0],
+                "AMT_CREDIT": [10.0, 20.0, 90.0],
+                "TARGET": [0.0, 0.0, 1.0],
+            }
+        )
+        new = {key: values[-1] for key, values in data.to_dict("list").items()}
+        new.update(SK_ID_CURR=4, AMT_CREDIT=60.0, TARGET=0.0)
+
+        stats = ml_tools.AcceptedStats(data.iloc[:2])
+        etag, chart_etag = stats.etag, stats.chart_etag
+        stats.add(new)
+        expected = ml_tools.AcceptedStats(pd.concat([data, pd.DataFrame([new])]))
+
+        assert stats.to_list() == expected.to_list()
+        assert stats.etag == expected.etag != etag
+        chart = stats.to_chart()
+        assert chart == expected.to_chart()
+        assert stats.chart_etag == expected.chart_etag != chart_etag
+        assert chart["features"] == ["AMT_CREDIT"]
+        assert chart["min"] == [10.0] and chart["max"] == [60.0]
+        assert chart["scaled_mean"] == [0.4]
+        assert chart["counts"]["CNT_CHILDREN"] == {
+            "values": [0.0, 1.0, 2.0],
+            "counts": [1, 1, 1],
+        }
+
+    def test_payloads_are_encoded_once(self):
+        stats = ml_tools.AcceptedStats(
+            pd.DataFrame(
+                {
+                    "SK_ID_CURR": [1, 2],
+                    "FLAG_OWN_CAR": [0, 1],
+                    "FLAG_OWN_REALTY": [1, 1],
+                    "CNT_CHILDREN": [0.0, 2.0],
+                    "AMT_CREDIT": [10.0, 20.0],
+                    "TARGET": [0, 0],
+                }
+            )
+        )
+        description, counts = json.loads(stats.payload)
+
+        assert pd.DataFrame(**description).loc["max", "AMT_CREDIT"] == 20.0
+        assert pd.DataFrame(**counts[2]).CNT_CHILDREN.to_dict() == {0.0: 1, 2.0: 1}
+        assert json.loads(encoding.dumps(np.array([0.25, 0.5]))) == [0.25, 0.5]
+
+    def test_arrow_stream_round_trip(self):
+        pa = pytest.importorskip("pyarrow")
+        stream = encoding.ArrowStream()
+        frames = [pd.DataFrame({"score": [0.1, 0.2]}), pd.DataFrame({"score": [0.3]})]
+
+        data = b"".join(stream.write(frame) for frame in frames) + stream.close()
+
+        assert pa.ipc.open_stream(data).read_pandas().score.tolist() == [0.1, 0.2, 0.3]
+
+    def test_columnar_backend(self, tmp_path):
+        train, labels = tmp_path / "train.csv", tmp_path / "labels.csv"
+        pd.DataFrame({"SK_ID_CURR": [1, 2], "AMT_CREDIT": [1.5, None]}).to_csv(
+            train, index=False
+        )
+        pd.DataFrame({"TARGET": [0.0, 1.0]}).to_csv(labels, index=False)
+        log = storage.DecisionLog(str(tmp_path / "decisions.log"))
+
+        def migrate():
+            return storage.migrate_csv(
+                storage.CsvBackend(str(train), str(labels)),
+                str(tmp_path / "columnar"),
+                log,
+            )
+
+        backend = migrate()
+        backend.append(
+            pd.DataFrame({"SK_ID_CURR": [3], "AMT_CREDIT": [2.5], "TARGET": [0.0]})
+        )
+        data = backend.read()
+
+        assert list(data.columns) == ["SK_ID_CURR", "AMT_CREDIT", "TARGET"]
+        assert data.SK_ID_CURR.tolist() == [1, 2, 3]
+        assert data.AMT_CREDIT.dtype == "float32"
+        assert data.TARGET.dtype == "int8"
+        assert list(backend.read(["TARGET"]).columns) == ["TARGET"]
+
+        # Every migration again keeps the rows appended before it.
+        for customer_id in [4, 5]:
+            backend = migrate()
+            assert backend.read_log().size == 0
+            backend.append(
+                pd.DataFrame(
+                    {"SK_ID_CURR": [customer_id], "AMT_CREDIT": [1.0], "TARGET": [1]}
+                )
+            )
+        assert migrate().read().SK_ID_CURR.tolist() == [1, 2, 3, 4, 5]
+
+    def test_schema_follows_customer_fields(self, tmp_path):
+        from app.prediction_server import Customer
+
+        types = storage.schema(list(Customer.__fields__))
+        assert types["SK_ID_CURR"] == np.int64
+        assert types["FLAG_OWN_CAR"] == types["TARGET"] == np.int8
+        assert types["EXT_SOURCE_1"] == types["CNT_CHILDREN"] == np.float32
+
+        train, labels = tmp_path / "train.csv", tmp_path / "labels.csv"
+        pd.DataFrame(
+            {"SK_ID_CURR": [1, 2], "FLAG_OWN_CAR": [1, 0], "AMT_CREDIT": [1.5, None]}
+        ).to_csv(train, index=False)
+        pd.DataFrame({"TARGET": [0.0, 1.0]}).to_csv(labels, index=False)
+        data = storage.CsvBackend(str(train), str(labels)).read()
+
+        assert data.dtypes.to_dict() == {
+            "SK_ID_CURR": np.int64,
+            "FLAG_OWN_CAR": np.int8,
+            "AMT_CREDIT": np.float32,
+            "TARGET": np.int8,
+        }
+
+    def test_decision_writer_compacts_log(self, tmp_path):
+        train, labels = tmp_path / "train.csv", tmp_path / "labels.csv"
+        pd.DataFrame({"SK_ID_CURR": [1], "AMT_CREDIT": [1.5]}).to_csv(
+            train, index=False
+        )
+        pd.DataFrame({"TARGET": [0.0]}).to_csv(labels, index=False)
+        backend = storage.CsvBackend(str(train), str(labels))
+        log = storage.DecisionLog(str(tmp_path / "decisions.log"))
+
+        writer = storage.DecisionWriter(log, backend)
+        writer.start()
+        writer.submit({"AMT_CREDIT": 2.5, "TARGET": 1.0, "SK_ID_CURR": 2})
+        writer.submit({"AMT_CREDIT": 3.5, "TARGET": 0.0, "SK_ID_CURR": 3})
+        writer.stop()
+
+        assert log.read_unlocked().empty
+        assert backend.read().values.tolist() == [
+            [1, 1.5, 0.0],
+            [2, 2.5, 1.0],
+            [3, 3.5, 0.0],
+        ]
+
+    def test_decision_compaction_resumes_after_a_crash(self, tmp_path, monkeypatch):
+        train, labels = tmp_path / "train.csv", tmp_path / "labels.csv"
+        train.write_text("SK_ID_CURR,AMT_CREDIT\n1,1.5\n")
+        labels.write_text("TARGET\n0\n")
+        backend = storage.CsvBackend(str(train), str(labels))
+        log = storage.DecisionLog(str(tmp_path / "decisions.log"))
+        log.append([{"SK_ID_CURR": 2, "AMT_CREDIT": 2.5, "TARGET": 1.0}])
+        append_synced = storage._append_synced
+
+        def crash_on_labels(path, rows):
+            if path == str(labels):
+                raise OSError("crash")
+            append_synced(path, rows)
+
+        monkeypatch.setattr(storage, "_append_synced", crash_on_labels)
+        with pytest.raises(OSError):
+            log.compact(backend)
+        # A partial line is left by the crash too.
+        with open(train, "a", encoding="utf-8") as file:
+            file.write("3,3")
+        monkeypatch.setattr(storage, "_append_synced", append_synced)
+
+        assert log.compact(backend) == 1
+        assert backend.read().values.tolist() == [[1, 1.5, 0], [2, 2.5, 1]]
+        assert log.compact(backend) == 0
+        with log.locked():
+            assert log.read_unlocked().empty
+            assert log.state_unlocked() == {"generation": 1}
+
+    def test_decision_log_is_read_from_a_position(self, tmp_path):
+        train, labels = tmp_path / "train.csv", tmp_path / "labels.csv"
+        train.write_text("SK_ID_CURR,AMT_CREDIT\n1,1.5\n")
+        labels.write_text("TARGET\n0\n")
+        backend = storage.CsvBackend(str(train), str(labels))
+        log = storage.DecisionLog(str(tmp_path / "decisions.log"))
+        log.append([{"SK_ID_CURR": 2, "AMT_CREDIT": 2.5, "TARGET": 1.0}])
+        with log.locked():
+            position = log.position_unlocked()
+        log.append([{"SK_ID_CURR": 3, "AMT_CREDIT": 3.5, "TARGET": 0.0}])
+        with open(log.path, "a", encoding="utf-8") as file:
+            file.write('{"SK_ID_CURR": 4')
+
+        def read_since(position):
+            with log.locked():
+                return log.read_since_unlocked(position)
+
+        rows, position = read_since(position)
+        assert rows["SK_ID_CURR"].tolist() == [3]
+        # Compacted once, the rows not read yet are in the previous log.
+        log.compact(backend)
+        log.append([{"SK_ID_CURR": 5, "AMT_CREDIT": 5.5, "TARGET": 0.0}])
+        rows, position = read_since(position)
+        assert rows["SK_ID_CURR"].tolist() == [5]
+        assert position == (1, (tmp_path / "decisions.log").stat().st_size)
+        log.compact(backend)
+        log.append([{"SK_ID_CURR": 6, "AMT_CREDIT": 6.5, "TARGET": 0.0}])
+        log.compact(backend)
+        assert read_since(position) is None
+
+    def test_prediction_sessions_are_shared(self, tmp_path):
+        backend = sessions.SqliteBackend(str(tmp_path / "sessions.sqlite3"))
+        worker_1 = sessions.PredictionSessions(backend, max_size=1)
+        worker_2 = sessions.PredictionSessions(backend, ttl=60)
+
+        first = worker_1.save(sessions.Prediction({"SK_ID_CURR": 1.0}, 0.4))
+        worker_1.save(sessions.Prediction({"SK_ID_CURR": 2.0}, 0.6))
+        old = worker_1.save(sessions.Prediction({}, 0.1, created_at=0))
+
+        assert worker_1.get(first).score == 0.4
+        assert worker_2.get(first).customer == {"SK_ID_CURR": 1.0}
+        assert worker_2.get(old) is None
+        assert worker_2.get("unknown") is None
+
+    def test_prediction_sessions_expire_by_save_count(self, tmp_path):
+        backend = sessions.SqliteBackend(str(tmp_path / "sessions.sqlite3"))
+        expired = []
+        backend.expire = expired.append
+        worker = sessions.PredictionSessions(backend, max_size=2, expire_every=5)
+
+        for _ in range(12):
+            worker.save(sessions.Prediction({}, 0.5))
+
+        assert len(expired) == 3
+
+    def test_executor_limits_concurrency(self):
+        pool = executor.Executor(limits={"predict": 2}, max_workers=4)
+        running, peak, lock = [0], [0], threading.Lock()
+
+        def work(value):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            return value
+
+        async def run_all():
+            return await asyncio.gather(
+                *[pool.run("predict", work, value) for value in range(6)]
+            )
+
+        assert asyncio.run(run_all()) == list(range(6))
+        assert peak[0] == 2
+        assert pool.metrics()["predict"]["completed"] == 6
+        pool.shutdown()
+
+    def test_executor_background_operations_keep_their_own_threads(self):
+        pool = executor.Executor(
+            limits={"predict": 1, "load_data": 1},
+            max_workers=1,
+            background=["load_data"],
+        )
+        loading = threading.Event()
+
+        async def predict_while_loading():
+            load = asyncio.ensure_future(pool.run("load_data", loading.wait, 5))
+            # Not stuck behind the load on the single request thread.
+            assert await pool.run("predict", lambda: 0.4) == 0.4
+            loading.set()
+            return await load
+
+        assert asyncio.run(predict_while_loading()) is True
+        pool.shutdown()
+
+    def test_micro_batcher_merges_concurrent_rows(self):
+        calls = []
+
+        def predict(matrix):
+            calls.append(len(matrix))
+            return matrix[:, 0] * 10
+
+        async def run(func, matrix):
+            return func(matrix)
+
+        async def score_all():
+            batcher = batching.MicroBatcher(predict, run, max_wait=0.01, max_batch=3)
+            rows = [np.array([value], dtype=np.float32) for value in range(5)]
+            scores = await asyncio.gather(*[batcher.submit(row) for row in rows])
+            return scores, batcher.batch_size.count
+
+        scores, batches = asyncio.run(score_all())
+
+        assert scores == [0.0, 10.0, 20.0, 30.0, 40.0]
+        assert calls == [3, 2]
+        assert batches == 2
+
+    def test_flat_forest_explain_sums_to_score(self):
+        rng = np.random.default_rng(1)
+        matrix = rng.normal(size=(300, 4))
+        model = RandomForestClassifier(n_estimators=4, random_state=0, n_jobs=1)
+        model.fit(matrix, matrix[:, 0] + rng.normal(size=300) > 0)
+        flat = forest.FlatForest.from_sklearn(model)
+
+        bias, contributions = flat.explain(matrix)
+
+        assert contributions.shape == (300, 4)
+        np.testing.assert_allclose(
+            bias + contributions.sum(axis=1),
+            model.predict_proba(matrix)[:, 1],
+            atol=1e-12,
+        )
+        assert np.abs(contributions).mean(axis=0).argmax() == 0
+
+    def test_flat_forest_matches_predict_proba(self):
+        generator = np.random.default_rng(0)
+        data = generator.normal(size=(2000, 4))
+        data[:, 3] = generator.integers(0, 3, 2000)
+        target = (data[:, 0] + data[:, 1] * data[:, 3] > 0.5).astype(int)
+        model = RandomForestClassifier(n_estimators=5, random_state=150, n_jobs=1)
+        model.fit(data, target)
+
+        flat = forest.FlatForest.from_sklearn(model)
+        rows = generator.normal(size=(500, 4))
+
+        assert np.array_equal(flat.predict_proba(rows), model.predict_proba(rows))
+        assert np.array_equal(
+            flat.predict_proba(rows[:1]), model.predict_proba(rows[:1])
+        )
+
+    def test_benchmark_compares_to_baseline(self):
+        result = benchmark.summarize([0.001, 0.002, float("nan"), 0.003], 0.5, None)
+        baseline = {"get_customer": {"8": asdict(result)}}
+        slower = dict(asdict(result), p95_ms=result.p95_ms + 5, errors=0)
+
+        assert result.requests == 4
+        assert result.errors == 1
+        assert result.p50_ms == 2.0
+        assert result.requests_per_second == 8.0
+        assert benchmark.compare({"get_customer": {"8": slower}}, baseline) == [
+            f"get_customer x8: p95_ms {slower['p95_ms']} > {result.p95_ms}"
+        ]
+        assert benchmark.compare({"train": {"1": slower}}, baseline) == []
+
+    def test_metrics_registry_renders_prometheus_text(self):
+        registry = metrics.Registry()
+        with registry.timer("predict"):
+            pass
+        registry.counter("hits_total", "Hits.", cache="a").inc(2)
+        registry.gauge("ratio", "Ratio.", lambda: 0.5)
+
+        text = registry.render()
+
+        assert "# TYPE risk_stage_duration_seconds histogram" in text
+        assert 'risk_stage_duration_seconds_bucket{stage="predict",le="+Inf"} 1' in text
+        assert 'risk_stage_duration_seconds_count{stage="predict"} 1' in text
+        assert 'hits_total{cache="a"} 2.0' in text
+        assert "ratio 0.5" in text
+
+    def test_metrics_of_the_workers_are_merged(self, tmp_path):
+        for worker, hits in [("11", 2), ("12", 3)]:
+            registry = metrics.Registry()
+            registry.counter("hits_total", "Hits.", cache="a").inc(hits)
+            registry.gauge("ratio", "Ratio.", lambda: 0.5)
+            registry.write(str(tmp_path / f"{worker}.prom"))
+        (tmp_path / "13.prom.tmp").write_text("partial")
+
+        text = metrics.merge_exports(metrics.read_exports(str(tmp_path)))
+
+        assert text.count("# TYPE hits_total counter") == 1
+        assert 'hits_total{cache="a",worker="11"} 2.0' in text
+        assert 'hits_total{cache="a",worker="12"} 3.0' in text
+        assert 'ratio{worker="12"} 0.5' in text
+
+    def test_gunicorn_workers_follow_request_cpu_share(self):
+        assert gunicorn_conf.worker_count(4, 3.0, 3.0) == 4
+        assert gunicorn_conf.worker_count(4, 1.0, 2.0) == 8
+        assert gunicorn_conf.worker_count(4, 0.1, 10.0) == 9
+        assert gunicorn_conf.worker_count(1, 0.0, 1.0) == 3
+
+    def test_api_prediction_and_explanation(self, api, monkeypatch):
+        prediction = api.post("/make_prediction", json=CUSTOMER).json()
+        assert set(prediction) == {"prediction_id", "score"}
+        assert 0.0 <= prediction["score"] <= 1.0
+
+        # Explained by the model that gave the score, even once replaced.
+        served = prediction_server.ARTIFACT
+        monkeypatch.setattr(
+            prediction_server, "ARTIFACT", replace(served, version="newer")
+        )
+        explained = api.get(f"/explain/{prediction['prediction_id']}").json()
+        assert explained["model_version"] == served.version
+        assert explained["score"] == prediction["score"]
+        assert explained["bias"] + sum(
+            explained["contributions"].values()
+        ) == pytest.approx(prediction["score"])
+
+    def test_api_batch_predictions(self, api):
+        score = api.post("/make_prediction", json=CUSTOMER).json()["score"]
+        other = {**CUSTOMER, "SK_ID_CURR": 100003, "EXT_SOURCE_1": 0.2}
+
+        # Batches are scored by chunks of one or two customers here.
+        batch = api.post(
+            "/make_predictions", json=[CUSTOMER, other], params={"chunk_size": 1}
+        )
+        assert batch.status_code == 200
+        assert batch.json()[0] == pytest.approx(score)
+        lines = api.post(
+            "/make_predictions",
+            content="\n".join(json.dumps(row) for row in [CUSTOMER, other, other]),
+            headers={"content-type": "application/x-ndjson"},
+            params={"chunk_size": 2},
+        )
+        assert lines.json() == batch.json() + batch.json()[1:]
+        for body, content_type in [
+            (json.dumps([CUSTOMER, {"SK_ID_CURR": "x"}]), "application/json"),
+            (json.dumps({"customers": [CUSTOMER]}), "application/json"),
+            (json.dumps(CUSTOMER) + "\n{", "application/x-ndjson"),
+        ]:
+            invalid = api.post(
+                "/make_predictions",
+                content=body,
+                headers={"content-type": content_type},
+                params={"chunk_size": 1},
+            )
+            assert invalid.status_code == 422
+
+    def test_api_caches(self, api):
+        for endpoint in ["/get_feature_importance", "/get_accepted_chart"]:
+            first = api.get(endpoint)
+            again = api.get(endpoint, headers={"If-None-Match": first.headers["etag"]})
+            assert first.status_code == 200
+            assert again.status_code == 304
+            assert again.content == b""
+
+    def test_api_decision_is_saved_and_exported(self, api):
+        prediction = api.post("/make_prediction", json=CUSTOMER).json()
+
+        unknown = api.post("/decision/true", params={"prediction_id": "x"})
+        assert unknown.status_code == 404
+        saved = api.post(
+            "/decision/true", params={"prediction_id": prediction["prediction_id"]}
+        )
+        assert saved.status_code == 200
+
+        export = api.get(
+            "/export/scores",
+            params={"output": "csv", "min_id": 100002, "max_id": 100003},
+        )
+        rows = pd.read_csv(io.StringIO(export.text))
+        assert export.headers["content-type"].startswith("text/csv")
+        # The saved decision is stored after the loaded customers.
+        assert rows.SK_ID_CURR.tolist() == [100002, 100003, 100002]
+        assert rows.score.between(0, 1).all()
+
+        # Stopping the writer compacts the decision into the data files.
+        prediction_server.WRITER.stop()
+        prediction_server.start_decision_writer()
+        stored = storage.CsvBackend().read()
+        assert len(stored) == API_CUSTOMERS + 1
+        assert stored.iloc[-1][["SK_ID_CURR", "TARGET"]].tolist() == [100002, 1]
+
+    def test_api_metrics_of_every_worker(self, api, monkeypatch, tmp_path):
+        monkeypatch.setattr(prediction_server.server_conf, "METRICS_DIR", str(tmp_path))
+        other = metrics.Registry()
+        other.counter("process_cpu_seconds_total", "CPU time.").inc(1.5)
+        other.write(str(tmp_path / "1.prom"))
+
+        text = api.get("/metrics").text
+
+        assert text.count("# TYPE process_cpu_seconds_total counter") == 1
+        assert 'process_cpu_seconds_total{worker="1"} 1.5' in text
+        assert f'process_cpu_seconds_total{{worker="{os.getpid()}"}}' in text
+
+    def test_api_training_and_rollback(self, api, monkeypatch):
+        # The training process died, a new one runs the job.
+        monkeypatch.setattr(prediction_server, "TRAINER", DeadPool())
+        monkeypatch.setattr(
+            prediction_server, "new_trainer", lambda: ThreadPoolExecutor(1)
+        )
+        monkeypatch.setattr(
+            model_store,
+            "run_training_job",
+            lambda job_id, incremental: model_store.write_job_status(
+                job_id, status="done", incremental=incremental
+            ),
+        )
+        job = api.post("/train_model", params={"incremental": True})
+        assert job.status_code == 202
+        prediction_server.TRAINER.shutdown(wait=True)
+        status = api.get(f"/train_model/{job.json()['job_id']}").json()
+        assert status["status"] == "done"
+        assert status["incremental"] is True
+
+        unknown = api.post("/model/rollback", params={"version": "../x"})
+        assert unknown.status_code == 404
+        no_previous = api.post("/model/rollback")
+        assert no_previous.status_code == 400